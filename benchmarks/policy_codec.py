@@ -0,0 +1,40 @@
+"""Compares size and encode/decode time of the stored policy encodings on the NINA example policy.
+
+Generated rooms are materialized into the policy first, as the processed copy of a large policy would be.
+Run from the repository root: python benchmarks/policy_codec.py [policy_key] [repetitions]
+"""
+import json
+import sys
+import timeit
+
+from secretary.codec import available_codecs, decode_policy, encode_policy
+from secretary.example_policies import get_example_policy
+from secretary.generators import iter_policy_rooms
+
+
+def materialize(policy):
+    policy = dict(policy)
+    policy['rooms'] = dict(iter_policy_rooms(policy))
+    policy.pop('room_generators', None)
+    return policy
+
+
+def run(policy_key='nina', repetitions=20):
+    policy = materialize(get_example_policy(policy_key))
+    print(f"{policy_key}: {len(policy['rooms'])} rooms, {repetitions} repetitions")
+    print(f"{'codec':<14}{'bytes':>12}{'ratio':>8}{'encode ms':>12}{'decode ms':>12}")
+    text = json.dumps(policy)
+    encode = timeit.timeit(lambda: json.dumps(policy), number=repetitions) / repetitions
+    decode = timeit.timeit(lambda: json.loads(text), number=repetitions) / repetitions
+    print(f"{'json (text)':<14}{len(text.encode('utf-8')):>12}{1:>8.2f}{encode * 1000:>12.2f}{decode * 1000:>12.2f}")
+    for codec in available_codecs():
+        data = encode_policy(policy, codec=codec)
+        assert decode_policy(data) == policy
+        encode = timeit.timeit(lambda: encode_policy(policy, codec=codec), number=repetitions) / repetitions
+        decode = timeit.timeit(lambda: decode_policy(data), number=repetitions) / repetitions
+        ratio = len(text.encode('utf-8')) / len(data)
+        print(f"{codec:<14}{len(data):>12}{ratio:>8.2f}{encode * 1000:>12.2f}{decode * 1000:>12.2f}")
+
+
+if __name__ == '__main__':
+    run(*(sys.argv[1:2] or ['nina']), *[int(n) for n in sys.argv[2:3]])
@@ -1,24 +1,51 @@
-import io
 import json
 from typing import Type
 
 from maubot import Plugin, MessageEvent
-from maubot.handlers import command
+from aiohttp.web import Request, Response
+from maubot.handlers import command, event, web
+from mautrix.client import Client
 from mautrix.errors import MTooLarge
-from mautrix.types import MediaMessageEventContent
+from mautrix.types import MediaMessageEventContent, UserID, EventType, StateEvent
 from mautrix.util.async_db import UpgradeTable
 from mautrix.util.config import BaseProxyConfig, ConfigUpdateHelper
 
 from secretary.database import get_upgrade_table
+from secretary import generators
+from secretary.diff import diff_policies
+from secretary.export import encode_json, export_file_name, export_mime_type
+from secretary.profiling import profile_call, ProfilerBusyError
 from secretary.rooms import create_room
 from secretary.secretary import MatrixSecretary
+from secretary.tracing import tracer
+from secretary.views import select_path, render
 from secretary.translations import echo
-from secretary.util import non_empty_string, PolicyNotFoundError, log_error
+from secretary.webapi import page_params, paginate, make_etag, cached_response, error_response, is_authorized
+from secretary.util import non_empty_string, parse_options, PolicyNotFoundError, log_error, get_logger, \
+    stop_logging, UserNotFoundError
+
+# mautrix has no EventType constant for guest access
+ROOM_GUEST_ACCESS = EventType.find('m.room.guest_access', t_class=EventType.Class.STATE)
 
 
 class Config(BaseProxyConfig):
     def do_update(self, helper: ConfigUpdateHelper) -> None:
         helper.copy("base_command")
+        helper.copy("max_concurrency")
+        helper.copy("db_checkpoint_rooms")
+        helper.copy("policy_codec")
+        helper.copy("helper_accounts")
+        helper.copy("requests_per_second")
+        helper.copy("request_burst")
+        helper.copy("admin_access_token")
+        helper.copy("admin_base_url")
+        helper.copy("debug_log_sample_rate")
+        helper.copy("enforce_state_events")
+        helper.copy("enforce_debounce_seconds")
+        helper.copy("http_api_token")
+        helper.copy("avatar_dir")
+        helper.copy("data_dir")
+        helper.copy("bot_join_timeout")
 
 
 class Secretary(Plugin):
@@ -39,6 +66,27 @@ class Secretary(Plugin):
     async def start(self) -> None:
         await super().start()
         self.config.load_and_update()
+        self.matrix_secretary.max_concurrency = self.config['max_concurrency']
+        self.matrix_secretary.db_checkpoint = self.config['db_checkpoint_rooms']
+        self.matrix_secretary.policy_codec = self.config['policy_codec']
+        self.matrix_secretary.avatar_dir = self.config['avatar_dir']
+        generators.data_dir = self.config['data_dir']
+        self.matrix_secretary.bot_join_timeout = self.config['bot_join_timeout']
+        helpers = [Client(mxid=UserID(account['user_id']), token=account['access_token'],
+                          base_url=account['base_url'] if 'base_url' in account else self.client.api.base_url,
+                          client_session=self.http)
+                   for account in self.config['helper_accounts'] or []]
+        self.matrix_secretary.set_admin_api(self.config['admin_base_url'] or self.client.api.base_url,
+                                            self.config['admin_access_token'], client_session=self.http)
+        self.matrix_secretary.accounts.configure(helpers, rate=self.config['requests_per_second'],
+                                                 burst=self.config['request_burst'])
+        get_logger(debug_sample_rate=self.config['debug_log_sample_rate'])
+        self.matrix_secretary.enforcer.delay = self.config['enforce_debounce_seconds']
+
+    async def stop(self) -> None:
+        await super().stop()
+        self.matrix_secretary.enforcer.cancel()
+        stop_logging()
 
     ############################
     # Plugin specific commands #
@@ -56,41 +104,64 @@ class Secretary(Plugin):
         reply = await self.matrix_secretary.set_notice_room(evt.room_id)
         await evt.reply(reply)
 
-    @sec.subcommand('show-policy', help="Show policy (JSON)")
-    @command.argument("policy_key", pass_raw=True, required=True, parser=non_empty_string)
-    async def show_policy(self, evt: MessageEvent, policy_key: str) -> None:
+    @sec.subcommand('show-policy', help="Show policy (JSON) or part of it: show-policy <key> [path], "
+                                        "e.g. rooms.Bayern, user_groups or rooms.*.alias")
+    @command.argument("args", pass_raw=True, required=True, parser=non_empty_string)
+    async def show_policy(self, evt: MessageEvent, args: str) -> None:
         if not await self._permission(evt, 100):
             return
+        policy_key, _, path = args.strip().partition(' ')
+        path = path.strip()
         try:
-            result = await self.matrix_secretary.get_policy(policy_key)
-            # convert dict to pretty printed json string
-            result = json.dumps(result, indent=4)  # , sort_keys=True)
+            result = select_path(await self.matrix_secretary.get_policy(policy_key), path)
+            # convert to pretty printed json string, only the selected part
+            result, fits_inline = render(result)
         except PolicyNotFoundError as err:
             self.matrix_secretary.logger.exception(err)
             await evt.respond(f"Policy {policy_key} not available.")
             return
+        except KeyError as err:
+            await evt.reply(f"Nothing to show at {path}: {err.args[0]}")
+            return
         except Exception as err:
             await log_error(self.matrix_secretary.logger, err, evt)
             return
 
+        file_name = f"{policy_key}{'_' + path if path else ''}.json"
         try:
-            await evt.reply(f"```\n{result}\n```", markdown=True)
+            if fits_inline:
+                await evt.reply(f"```\n{result}\n```", markdown=True)
+            else:
+                await evt.respond(f"{path or 'Policy'} too large to display, sending it as a file.")
+                await self._send_as_file(evt, result, file_name=file_name, mime_type="application/json")
         except MTooLarge:
             await evt.respond("Policy too large to display.")
-            await self._send_as_file(evt, result, file_name=f"{policy_key}.json")
+            await self._send_as_file(evt, result, file_name=file_name, mime_type="application/json")
         except Exception as err:
             await log_error(self.matrix_secretary.logger, err, evt)
 
-    @sec.subcommand('export-policy', help="Export policy as file (JSON)")
-    @command.argument("policy_key", pass_raw=True, required=True, parser=non_empty_string)
-    async def export_policy(self, evt: MessageEvent, policy_key: str) -> None:
+    @sec.subcommand('export-policy', help="Export policy as file: export-policy <key> [full|mapping|diff] [--gzip]")
+    @command.argument("args", pass_raw=True, required=True, parser=non_empty_string)
+    async def export_policy(self, evt: MessageEvent, args: str) -> None:
         if not await self._permission(evt, 100):
             return
+        positional, options = parse_options(args)
+        policy_key, _, mode = positional.partition(' ')
+        compress = 'gzip' in options
+        mode = mode.strip() or 'full'
+        if mode not in ['full', 'mapping', 'diff']:
+            await evt.reply(f"Unknown export mode {mode}, use one of full, mapping, diff.")
+            return
         try:
-            policy_original = await self.matrix_secretary.get_policy(policy_key, export_mode=False)
-            policy_processed = await self.matrix_secretary.get_policy(policy_key, export_mode=True)
-            policy_original = json.dumps(policy_original, indent=4)
-            policy_processed = json.dumps(policy_processed, indent=4, sort_keys=True)
+            if mode == 'mapping':
+                exports = {'room_ids': await self.matrix_secretary.get_room_ids(policy_key)}
+            else:
+                policy_original = await self.matrix_secretary.get_policy(policy_key, export_mode=False)
+                policy_processed = await self.matrix_secretary.get_policy(policy_key, export_mode=True)
+                if mode == 'diff':
+                    exports = {'diff': diff_policies(policy_original, policy_processed)}
+                else:
+                    exports = {'original': policy_original, 'processed': policy_processed}
         except PolicyNotFoundError as err:
             self.matrix_secretary.logger.exception(err)
             await evt.respond(f"Policy {policy_key} not available.")
@@ -101,22 +172,55 @@ class Secretary(Plugin):
 
         try:
             await evt.respond("Export successful.")
-            await self._send_as_file(evt, policy_original, file_name=f"{policy_key}_original.json")
-            await self._send_as_file(evt, policy_processed, file_name=f"{policy_key}_processed.json")
+            for name, content in exports.items():
+                # serialize and upload one file at a time
+                data = encode_json(content, compress=compress, sort_keys=(name != 'original'))
+                await self._send_as_file(evt, data, file_name=export_file_name(f"{policy_key}_{name}", compress),
+                                         mime_type=export_mime_type(compress))
         except Exception as err:
             await log_error(self.matrix_secretary.logger, err, evt)
 
-    @sec.subcommand('load-sample-policies', help="Load example policies")
-    async def load_sample_policies(self, evt: MessageEvent) -> None:
+    @sec.subcommand('load-sample-policies', help="Load example policies (all but the large synthetic one, "
+                                                  "or the given policy keys)")
+    @command.argument("policy_keys", pass_raw=True, required=False)
+    async def load_sample_policies(self, evt: MessageEvent, policy_keys: str = None) -> None:
         if not await self._permission(evt, 100):
             return
         try:
-            await self.matrix_secretary.load_example_policies()
-            await evt.respond("Loaded example policies from secretary/example_policies.")
+            loaded = await self.matrix_secretary.load_example_policies(policy_keys.split() if policy_keys else None)
+            await evt.respond(f"Loaded example policies {', '.join(loaded)} from secretary/example_policies.")
             await self.list_policies(evt)
         except Exception as err:
             await log_error(self.matrix_secretary.logger, err, evt)
 
+    @sec.subcommand('generate-policy',
+                    help="Add a synthetic policy for scale tests: generate-policy [--rooms 1000] [--depth 3] "
+                         "[--fan-out 10] [--groups 5] [--group-size 20] [--invitees 5] [--bot-actions 0.1] "
+                         "[--no-aliases] [--seed 0] [--key <policy_key>]")
+    @command.argument("args", pass_raw=True, required=False)
+    async def generate_policy(self, evt: MessageEvent, args: str = None) -> None:
+        if not await self._permission(evt, 100):
+            return
+        _, options = parse_options(args or '')
+        params = {}
+        try:
+            for option, param, convert in [('rooms', 'rooms', int), ('depth', 'depth', int),
+                                           ('fan-out', 'fan_out', int), ('groups', 'user_groups', int),
+                                           ('group-size', 'group_size', int), ('invitees', 'invitees', int),
+                                           ('bot-actions', 'bot_actions', float), ('seed', 'seed', int),
+                                           ('key', 'policy_key', str)]:
+                if option in options:
+                    params[param] = convert(options[option])
+        except ValueError as err:
+            await evt.reply(f"Invalid option: {err}")
+            return
+        params['aliases'] = 'no-aliases' not in options
+        try:
+            policy = await self.matrix_secretary.add_synthetic_policy(**params)
+            await evt.respond(f"Added policy {policy['policy_key']}: {policy['policy_description']}")
+        except Exception as err:
+            await log_error(self.matrix_secretary.logger, err, evt)
+
     @sec.subcommand('list-policies', help="Show all policies")
     async def list_policies(self, evt: MessageEvent) -> None:
         if not await self._permission(evt, -1):
@@ -127,14 +231,158 @@ class Secretary(Plugin):
         except Exception as err:
             await log_error(self.matrix_secretary.logger, err, evt)
 
-    @sec.subcommand('ensure-policy', help="Ensures policy is implemented, creates rooms if necessary")
+    @sec.subcommand('ensure-policy',
+                    help="Ensures policy is implemented, creates rooms if necessary: "
+                         "ensure-policy <key> [--subtree <room_key>] [--rooms a,b,c] [--changed]")
+    @command.argument("args", pass_raw=True, required=True, parser=non_empty_string)
+    async def ensure_policy(self, evt: MessageEvent, args: str) -> None:
+        if not await self._permission(evt, 100):
+            return
+        policy_key, options = parse_options(args)
+        try:
+            if 'changed' in options:
+                # only rooms affected by changes since the last ensured version
+                room_keys, failures = await self.matrix_secretary.ensure_changed(policy_key)
+                reply = "Policy implemented" if room_keys is None else f"Policy implemented for {len(room_keys)} changed rooms"
+                await evt.reply(self._ensure_reply(reply, policy_key, failures))
+                return
+            room_keys = None
+            if 'subtree' in options:
+                graph = await self.matrix_secretary.get_policy_graph(policy_key)
+                if options['subtree'] not in graph:
+                    await evt.reply(f"Room {options['subtree']} is not part of policy {policy_key}.")
+                    return
+                room_keys = graph.subtree(options['subtree'])
+            if 'rooms' in options:
+                room_keys = (room_keys or set()) | {k.strip() for k in str(options['rooms']).split(',') if k.strip()}
+            failures = await self.matrix_secretary.ensure_policy(policy_key, room_keys=room_keys)
+            reply = "Policy implemented" if room_keys is None else f"Policy implemented for {len(room_keys)} rooms"
+            await evt.reply(self._ensure_reply(reply, policy_key, failures))
+        except Exception as err:
+            await log_error(self.matrix_secretary.logger, err, evt)
+
+    @sec.subcommand('retry-failed', help="Re-run only the rooms of a policy that failed before: retry-failed <key>")
     @command.argument("policy_key", pass_raw=True, required=True, parser=non_empty_string)
-    async def ensure_policy(self, evt: MessageEvent, policy_key: str) -> None:
+    async def retry_failed(self, evt: MessageEvent, policy_key: str) -> None:
+        if not await self._permission(evt, 100):
+            return
+        try:
+            room_keys, failures = await self.matrix_secretary.retry_failed(policy_key.strip())
+            if not room_keys:
+                await evt.reply(f"No failed rooms to retry in policy {policy_key.strip()}.")
+                return
+            await evt.reply(self._ensure_reply(f"Retried {len(room_keys)} rooms", policy_key.strip(), failures))
+        except Exception as err:
+            await log_error(self.matrix_secretary.logger, err, evt)
+
+    @sec.subcommand('diff-policy', help="Show changes between two uploaded versions of a policy: "
+                                        "diff-policy <key> [old_version] [new_version]")
+    @command.argument("args", pass_raw=True, required=True, parser=non_empty_string)
+    async def diff_policy(self, evt: MessageEvent, args: str) -> None:
+        if not await self._permission(evt, 100):
+            return
+        policy_key, *versions = args.split()
+        try:
+            versions = [int(v) for v in versions]
+            if len(versions) == 1:
+                # a single version is compared to the latest one
+                versions.append(None)
+            old_version, new_version, diff = await self.matrix_secretary.diff_policy_versions(policy_key, *versions[:2])
+        except PolicyNotFoundError as err:
+            self.matrix_secretary.logger.exception(err)
+            await evt.respond(f"Policy {policy_key} not available.")
+            return
+        except ValueError as err:
+            await evt.reply(f"Can't diff {policy_key}: {err}")
+            return
+        except Exception as err:
+            await log_error(self.matrix_secretary.logger, err, evt)
+            return
+
+        rooms = diff.get('rooms', {})
+        summary = (f"{policy_key} v{old_version} → v{new_version}: "
+                   f"{sum('added' in r for r in rooms.values())} rooms added, "
+                   f"{sum('removed' in r for r in rooms.values())} removed, "
+                   f"{sum('changed' in r for r in rooms.values())} changed, "
+                   f"fields changed: {', '.join(diff.get('fields', {}).keys()) or 'none'}")
+        result = json.dumps(diff, indent=4)
+        try:
+            await evt.reply(f"{summary}\n```\n{result}\n```", markdown=True)
+        except MTooLarge:
+            await evt.respond(summary)
+            await self._send_as_file(evt, result, file_name=f"{policy_key}_v{old_version}_v{new_version}.json",
+                                     mime_type="application/json")
+        except Exception as err:
+            await log_error(self.matrix_secretary.logger, err, evt)
+
+    @sec.subcommand('trace', help="Upload the spans of a recent run as Chrome trace JSON: trace [run id or prefix]")
+    @command.argument("run", pass_raw=True, required=False)
+    async def trace(self, evt: MessageEvent, run: str = None) -> None:
         if not await self._permission(evt, 100):
             return
+        run_id = tracer.find_run(run.strip() or None if run else None)
+        if run_id is None:
+            await evt.reply("No traced run found. Recent runs:\n  " + '\n  '.join(tracer.get_run_ids()))
+            return
         try:
-            await self.matrix_secretary.ensure_policy(policy_key)
-            await evt.reply("Policy implemented")
+            trace = tracer.chrome_trace(run_id)
+            await evt.respond(f"Trace of {run_id} ({len(trace['traceEvents']) - 1} spans), "
+                              f"open it in chrome://tracing or ui.perfetto.dev")
+            await self._send_as_file(evt, encode_json(trace, compress=True), file_name=export_file_name(run_id, True),
+                                     mime_type=export_mime_type(True))
+        except Exception as err:
+            await log_error(self.matrix_secretary.logger, err, evt)
+
+    @sec.subcommand('profile', help="Run a subcommand under the profiler and upload the stats: "
+                                    "profile <subcommand> [arguments]")
+    @command.argument("args", pass_raw=True, required=True, parser=non_empty_string)
+    async def profile(self, evt: MessageEvent, args: str) -> None:
+        if not await self._permission(evt, 100):
+            return
+        name, _, remaining = args.strip().partition(' ')
+        handler = self._find_subcommand(name)
+        if handler is None or handler.__mb_func__ is self.profile.__mb_func__:
+            await evt.reply(f"Unknown subcommand {name}.")
+            return
+        try:
+            data, summary = await profile_call(lambda: self._run_subcommand(handler, evt, remaining.strip()))
+        except ProfilerBusyError as err:
+            await evt.reply(f"{err}, try again later.")
+            return
+        except Exception as err:
+            await log_error(self.matrix_secretary.logger, err, evt)
+            return
+        await self._send_as_file(evt, data, file_name=f"profile_{name}.prof", mime_type="application/octet-stream")
+        try:
+            await evt.respond(f"```\n{summary}\n```", markdown=True)
+        except MTooLarge:
+            await self._send_as_file(evt, summary, file_name=f"profile_{name}.txt")
+
+    @sec.subcommand('prune-rooms', help="List rooms removed from a policy, --apply handles them as the policy's "
+                                        "removed_rooms setting says: prune-rooms <key> [--apply] "
+                                        "[--mode unlink|archive|delete]")
+    @command.argument("args", pass_raw=True, required=True, parser=non_empty_string)
+    async def prune_rooms(self, evt: MessageEvent, args: str) -> None:
+        if not await self._permission(evt, 100):
+            return
+        policy_key, options = parse_options(args)
+        mode = options['mode'] if isinstance(options.get('mode'), str) else None
+        try:
+            if 'apply' not in options:
+                _, orphans = await self.matrix_secretary.get_removed_rooms(policy_key)
+                if not orphans:
+                    await evt.reply(f"No rooms were removed from {policy_key}.")
+                    return
+                listed = '\n  '.join(f"{room_key}: {room_id}" for room_key, room_id in sorted(orphans.items()))
+                await evt.reply(f"{len(orphans)} rooms were removed from {policy_key} (dry run):\n  {listed}\n"
+                                f"Use --apply to handle them.")
+                return
+            mode, orphans, failures = await self.matrix_secretary.prune_removed_rooms(policy_key, mode=mode)
+            if mode == 'keep':
+                await evt.reply(f"Policy {policy_key} keeps removed rooms, pass --mode unlink|archive|delete.")
+                return
+            await evt.reply(self._ensure_reply(f"Pruned {len(orphans) - len(failures)} rooms ({mode})",
+                                               policy_key, failures))
         except Exception as err:
             await log_error(self.matrix_secretary.logger, err, evt)
 
@@ -171,6 +419,33 @@ class Secretary(Plugin):
         except Exception as err:
             await log_error(self.matrix_secretary.logger, err, evt=evt)
 
+    @sec.subcommand('ensure-user', help="Invite a user (or user group) to their managed rooms, ensure power levels")
+    @command.argument("user", pass_raw=True, required=True, parser=non_empty_string)
+    async def ensure_user(self, evt: MessageEvent, user: str) -> None:
+        if not await self._permission(evt, 100):
+            return
+        try:
+            failures = await self.matrix_secretary.ensure_user(user.strip())
+            await evt.reply(self._user_update_reply(user.strip(), "ensured", failures))
+        except UserNotFoundError as err:
+            await evt.reply(str(err))
+        except Exception as err:
+            await log_error(self.matrix_secretary.logger, err, evt)
+
+    @sec.subcommand('offboard-user', help="Kick a user (or user group) from their managed rooms, reset power levels")
+    @command.argument("user", pass_raw=True, required=True, parser=non_empty_string)
+    async def offboard_user(self, evt: MessageEvent, user: str) -> None:
+        if not await self._permission(evt, 100):
+            return
+        try:
+            failures = await self.matrix_secretary.offboard_user(user.strip())
+            reply = self._user_update_reply(user.strip(), "offboarded", failures)
+            await evt.reply(reply + "\nRemove them from the policies, or the next ensure-policy will invite them again.")
+        except UserNotFoundError as err:
+            await evt.reply(str(err))
+        except Exception as err:
+            await log_error(self.matrix_secretary.logger, err, evt)
+
     @sec.subcommand('destroy-policy', help="Remove policy and delete rooms")
     @command.argument("policy_key", pass_raw=True, required=True, parser=non_empty_string)
     async def rm_policy(self, evt: MessageEvent, policy_key: str) -> None:
@@ -194,6 +469,94 @@ class Secretary(Plugin):
         except Exception as err:
             await log_error(self.matrix_secretary.logger, err, evt)
 
+    @event.on(EventType.ROOM_POWER_LEVELS)
+    @event.on(EventType.ROOM_JOIN_RULES)
+    @event.on(EventType.ROOM_NAME)
+    @event.on(EventType.ROOM_TOPIC)
+    @event.on(EventType.ROOM_HISTORY_VISIBILITY)
+    @event.on(ROOM_GUEST_ACCESS)
+    async def enforce_room_state(self, evt: StateEvent) -> None:
+        # Managed rooms are reconciled when someone changes their state, see MatrixSecretary.handle_state_event
+        if not self.config['enforce_state_events']:
+            return
+        await self.matrix_secretary.handle_state_event(evt.room_id, evt.sender, str(evt.type))
+
+    ##########################
+    # Read-only HTTP API     #
+    ##########################
+
+    @web.get("/policies")
+    async def api_policies(self, request: Request) -> Response:
+        async def handle():
+            offset, limit = page_params(request)
+            policies = [{'policy_key': policy_key, 'version': version}
+                        for policy_key, version in (await self.matrix_secretary.get_policy_version_tags()).items()]
+
+            async def build():
+                return paginate(policies, offset, limit)
+
+            return await cached_response(request, make_etag(policies, offset, limit), build)
+
+        return await self._api(request, handle)
+
+    @web.get("/policies/{policy_key}/room-ids")
+    async def api_room_ids(self, request: Request) -> Response:
+        async def handle():
+            policy_key = request.match_info['policy_key']
+            offset, limit = page_params(request)
+            room_ids = await self.matrix_secretary.get_room_ids(policy_key)
+
+            async def build():
+                return paginate([{'room_key': room_key, 'room_id': room_ids[room_key]}
+                                 for room_key in sorted(room_ids)], offset, limit)
+
+            return await cached_response(request, make_etag(policy_key, room_ids, offset, limit), build)
+
+        return await self._api(request, handle)
+
+    @web.get("/policies/{policy_key}/rooms/{room_key:.+}")
+    async def api_room(self, request: Request) -> Response:
+        async def handle():
+            policy_key, room_key = request.match_info['policy_key'], request.match_info['room_key']
+            version = await self.matrix_secretary.get_policy_version_tag(policy_key)
+            room_id = (await self.matrix_secretary.get_room_ids(policy_key)).get(room_key)
+
+            async def build():
+                # the policy is only loaded if the client doesn't have this version of the room yet
+                room_policy = await self.matrix_secretary.get_room_policy(policy_key, room_key)
+                return {'room_key': room_key, 'room_id': room_id, 'policy_version': version, 'policy': room_policy}
+
+            return await cached_response(request, make_etag(policy_key, room_key, version, room_id), build)
+
+        return await self._api(request, handle)
+
+    @web.get("/users/{user}/rooms")
+    async def api_user_rooms(self, request: Request) -> Response:
+        async def handle():
+            # user id or user group name
+            offset, limit = page_params(request)
+            rooms = await self.matrix_secretary.get_user_rooms(request.match_info['user'])
+
+            async def build():
+                return paginate(rooms, offset, limit)
+
+            return await cached_response(request, make_etag(rooms, offset, limit), build)
+
+        return await self._api(request, handle)
+
+    async def _api(self, request, handle):
+        if not is_authorized(request, self.config['http_api_token']):
+            return error_response(401, "Missing or invalid token (the API is disabled if no http_api_token is set)")
+        try:
+            return await handle()
+        except PolicyNotFoundError as err:
+            return error_response(404, str(err))
+        except ValueError as err:
+            return error_response(400, str(err))
+        except Exception as err:
+            self.matrix_secretary.logger.exception("HTTP API request %s failed: %s", request.path, err)
+            return error_response(500, "Internal error")
+
     @classmethod
     def get_db_upgrade_table(cls) -> UpgradeTable | None:
         return get_upgrade_table()
@@ -207,22 +570,42 @@ class Secretary(Plugin):
         await evt.reply(f"You don't have permission to do that, sorry. You need to be at least level {min_level} (you're level {sender_lvl}).")
         return False
 
-    async def _send_as_file(self, evt: MessageEvent, file_content, file_name='text.txt') -> None:
+    def _find_subcommand(self, name):
+        for handler in self.sec.__mb_subcommands__:
+            if handler.__mb_is_command_match__(self, name):
+                return handler
+        return None
+
+    async def _run_subcommand(self, handler, evt, remaining):
+        # Subcommands take at most one raw argument, which is passed on unparsed
+        arguments = handler.__mb_arguments__
+        kwargs = {arguments[0].name: remaining} if arguments and remaining else {}
+        await handler.__mb_func__(self, evt, **kwargs)
+
+    @staticmethod
+    def _user_update_reply(user, action, failures):
+        if not failures:
+            return f"Successfully {action} {user}"
+        return f"{user} {action}, except for:\n  " + '\n  '.join([f"{r}: {e}" for r, e in failures])
+
+    @staticmethod
+    def _ensure_reply(reply, policy_key, failures, max_listed=20):
+        if not failures:
+            return reply
+        listed = [f"{room_key} ({phase}): {err}" for room_key, (phase, err) in list(failures.items())[:max_listed]]
+        if len(failures) > max_listed:
+            listed.append(f"... and {len(failures) - max_listed} more")
+        return (f"{reply}, except for {len(failures)} rooms:\n  " + '\n  '.join(listed) +
+                f"\nUse retry-failed {policy_key} to re-run only these rooms.")
+
+    async def _send_as_file(self, evt: MessageEvent, file_content, file_name='text.txt',
+                            mime_type="text/plain") -> None:
         room_id = evt.room_id
+        data = file_content.encode('utf-8') if isinstance(file_content, str) else file_content
 
-        # Create a temporary in-memory buffer for the text file
-        try:
-            buffer = io.StringIO()
-            buffer.write(file_content)
-            buffer.seek(0)  # Reset the buffer's position to the beginning
-        except Exception as err:
-            await log_error(self.matrix_secretary.logger, err, evt)
-            return
-
-        # Send the text file as a message
+        # Send the file as a message
         try:
-            data = buffer.getvalue().encode('utf-8')
-            uri = await self.client.upload_media(data, mime_type="text/plain")
+            uri = await self.client.upload_media(data, mime_type=mime_type, filename=file_name)
             await self.client.send_file(room_id, uri, file_name=file_name)
         except Exception as err:
             await log_error(self.matrix_secretary.logger, err, evt)
@@ -0,0 +1,141 @@
+import asyncio
+import inspect
+import re
+import time
+import zlib
+from contextvars import ContextVar
+
+from secretary.tracing import span
+
+
+class RateBudget:
+    """Token bucket allowing `rate` requests per second with bursts of up to `burst` requests (rate 0: unlimited)."""
+
+    def __init__(self, rate=0, burst=1):
+        self.lock = asyncio.Lock()
+        self.configure(rate, burst)
+
+    def configure(self, rate, burst):
+        self.rate = rate
+        self.burst = max(burst, 1)
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+
+    async def acquire(self):
+        if not self.rate:
+            return
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+class BudgetedClient:
+    """Wraps a mautrix client so that every request (client methods and api.request) takes a token first.
+
+    Besides coroutine functions, mautrix has plain methods returning awaitables (send_text, send_file, ...), so every
+    method whose result is awaitable is budgeted. The request only starts when the result is awaited.
+    """
+
+    def __init__(self, client, budget):
+        self.client = client
+        self.budget = budget
+        self.api = _BudgetedAPI(client.api, budget)
+
+    def __getattr__(self, name):
+        attr = getattr(self.client, name)
+        if not callable(attr):
+            return attr
+
+        def call(*args, **kwargs):
+            result = attr(*args, **kwargs)
+            return self._budgeted(name, result) if inspect.isawaitable(result) else result
+
+        return call
+
+    async def _budgeted(self, name, awaitable):
+        with span(name, cat='matrix', account=self.client.mxid):
+            await self.budget.acquire()
+            return await awaitable
+
+
+class _BudgetedAPI:
+    def __init__(self, api, budget):
+        self.api = api
+        self.budget = budget
+
+    def __getattr__(self, name):
+        return getattr(self.api, name)
+
+    async def request(self, method, path, *args, **kwargs):
+        # ids are cut from span names, so the same endpoint always has the same name
+        with span(f"{getattr(method, 'value', method)} {re.sub(r'[!@#$][^/?]*', '{id}', str(path))}", cat='matrix', path=path):
+            await self.budget.acquire()
+            return await self.api.request(method, path, *args, **kwargs)
+
+
+class AccountPool:
+    """The primary bot account plus optional helper accounts that share the work of ensuring policies.
+
+    Every room has a single owning account for a whole run: room keys are partitioned across all accounts by hash,
+    existing rooms the partitioned helper hasn't joined fall back to the primary account.
+    Owners are kept per run (in the context of the task running it), so concurrent runs don't see each other's rooms.
+    """
+
+    def __init__(self, primary):
+        self.primary = BudgetedClient(primary, RateBudget())
+        self.helpers = []
+        self.joined = {}
+        self.run_owners = ContextVar('secretary_run_owners', default=None)
+
+    def configure(self, helpers=(), rate=0, burst=1):
+        self.primary.budget.configure(rate, burst)
+        self.helpers = [BudgetedClient(h, RateBudget(rate, burst)) for h in helpers]
+        self.joined = {}
+
+    @property
+    def accounts(self):
+        return [self.primary] + self.helpers
+
+    @property
+    def owners(self):
+        # Outside of runs (ensure-user, enforcement) nothing is owned, all rooms go to the primary account
+        owners = self.run_owners.get()
+        return {} if owners is None else owners
+
+    async def refresh(self):
+        # Called at the start of each run: starts its owners, which are decided from these joined rooms.
+        # Tasks started by the run share its owners
+        self.run_owners.set({})
+        for helper in self.helpers:
+            self.joined[helper.mxid] = set(await helper.get_joined_rooms())
+
+    def owner(self, room_key, room_id=None):
+        account = self.accounts[zlib.crc32(room_key.encode('utf-8')) % len(self.accounts)]
+        if room_id is not None and account is not self.primary and room_id not in self.joined.get(account.mxid, ()):
+            account = self.primary
+        if room_id is not None:
+            self.owners[room_id] = account
+        return account
+
+    def assign(self, room_id, account):
+        # Rooms created by an account are owned by it for the rest of the run
+        self.owners[room_id] = account
+        self.joined.setdefault(account.mxid, set()).add(room_id)
+
+    def helper_rooms(self):
+        # Rooms owned by a helper account in the current run, created by it or left over from a failed hand over
+        return {room_id: account for room_id, account in self.owners.items() if account is not self.primary}
+
+    def release(self, room_id, account):
+        # The helper left the room, the primary account owns it from now on
+        self.owners[room_id] = self.primary
+        self.joined.get(account.mxid, set()).discard(room_id)
+
+    def client_for(self, room_id):
+        return self.owners.get(room_id, self.primary)
@@ -0,0 +1,65 @@
+from urllib.parse import quote
+
+from mautrix.api import HTTPAPI, Method
+from mautrix.errors import MatrixRequestError
+
+from secretary.util import AdminAPIUnavailableError
+
+
+class SynapseAdminAPI:
+    """Fast paths through the Synapse admin API, used when admin credentials are configured.
+
+    The first request that is refused (not an admin, no Synapse, endpoint missing) marks the API as unavailable;
+    callers then fall back to the client API. Errors about the request itself (e.g. M_NOT_FOUND for an unknown room)
+    are raised to the caller. base_url can point to any stand-in implementing these endpoints, see
+    tools/fake_synapse_admin.py.
+    """
+
+    def __init__(self, base_url, access_token, client_session=None):
+        self.api = HTTPAPI(base_url=base_url, token=access_token, client_session=client_session)
+        self.available = True
+
+    async def request(self, method, path, content=None, query_params=None):
+        if not self.available:
+            raise AdminAPIUnavailableError("Admin API not available")
+        try:
+            return await self.api.request(method, path, content=content, query_params=query_params)
+        except MatrixRequestError as err:
+            if self._is_refusal(err):
+                self.available = False
+                raise AdminAPIUnavailableError(f"Admin API not available: {err}") from err
+            raise
+
+    @staticmethod
+    def _is_refusal(err):
+        # 404/405 without a Matrix error code: the endpoint doesn't exist behind e.g. a reverse proxy
+        errcode = getattr(err, 'errcode', None)
+        return err.http_status in [401, 403] or errcode == 'M_UNRECOGNIZED' or \
+            (err.http_status in [404, 405] and not errcode)
+
+    async def delete_room(self, room_id, purge=True):
+        # Kicks all local users, removes aliases and (with purge) deletes the room from the database in one call
+        path = f"/_synapse/admin/v2/rooms/{quote(room_id)}"
+        return await self.request(Method.DELETE, path, content={'purge': purge, 'message': "Room deletion."})
+
+    async def get_room(self, room_id):
+        # Room details, raises MNotFound for rooms the server doesn't know
+        return await self.request(Method.GET, f"/_synapse/admin/v1/rooms/{quote(room_id)}")
+
+    async def list_rooms(self, page_size=500):
+        # room id -> room details (name, canonical_alias, joined_members, joined_local_members, ...)
+        rooms = {}
+        params = {'limit': str(page_size)}
+        while True:
+            result = await self.request(Method.GET, "/_synapse/admin/v1/rooms", query_params=params)
+            for room in result.get('rooms', []):
+                rooms[room['room_id']] = room
+            if 'next_batch' not in result or result['next_batch'] is None:
+                return rooms
+            params['from'] = str(result['next_batch'])
+
+    async def join_user(self, room_id_or_alias, user_id):
+        # Force-joins a local user, e.g. the bot into a room it should adopt
+        path = f"/_synapse/admin/v1/join/{quote(room_id_or_alias)}"
+        result = await self.request(Method.POST, path, content={'user_id': user_id})
+        return result['room_id']
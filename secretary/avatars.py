@@ -0,0 +1,63 @@
+import asyncio
+import hashlib
+import mimetypes
+import os
+from urllib.parse import urlparse
+
+from secretary.util import confined_path
+
+# Room avatars are small, anything larger is most likely a wrong link
+MAX_AVATAR_BYTES = 10 * 1024 * 1024
+
+
+def is_mxc(source):
+    return source.startswith('mxc://')
+
+
+def content_hash(data: bytes) -> str:
+    return hashlib.sha256(data).hexdigest()
+
+
+async def load_image(source, session, avatar_dir=None):
+    # Returns the image (bytes), its mime type and a file name for http(s) URLs, file:// URLs and local paths.
+    # session is an aiohttp ClientSession. Local files are read from avatar_dir only, without one they are refused
+    url = urlparse(source)
+    if url.scheme in ['http', 'https']:
+        async with session.get(source) as resp:
+            resp.raise_for_status()
+            if resp.content_length is not None and resp.content_length > MAX_AVATAR_BYTES:
+                raise ValueError(f"Avatar {source} is larger than {MAX_AVATAR_BYTES} bytes")
+            data = bytearray()
+            async for chunk in resp.content.iter_chunked(64 * 1024):
+                data.extend(chunk)
+                if len(data) > MAX_AVATAR_BYTES:
+                    raise ValueError(f"Avatar {source} is larger than {MAX_AVATAR_BYTES} bytes")
+            data = bytes(data)
+            mime_type = resp.content_type
+    elif url.scheme in ['', 'file']:
+        path = avatar_path(url.path if url.scheme == 'file' else source, avatar_dir)
+        data = await asyncio.get_running_loop().run_in_executor(None, _read_file, path)
+        mime_type = None
+    else:
+        raise ValueError(f"Avatar {source} is neither an mxc:// or http(s) URL nor a file")
+    if len(data) > MAX_AVATAR_BYTES:
+        raise ValueError(f"Avatar {source} is larger than {MAX_AVATAR_BYTES} bytes")
+    file_name = os.path.basename(url.path) or 'avatar'
+    if not mime_type or mime_type == 'application/octet-stream':
+        mime_type = mimetypes.guess_type(file_name)[0] or 'application/octet-stream'
+    return data, mime_type, file_name
+
+
+def avatar_path(path, avatar_dir):
+    # Paths (file:// URLs and a leading / too) are relative to avatar_dir, anything resolving outside of it is refused
+    if not avatar_dir:
+        raise ValueError(f"Avatar {path} is a local file, but no avatar directory is configured")
+    resolved = confined_path(path, avatar_dir)
+    if resolved is None:
+        raise ValueError(f"Avatar {path} is outside of the avatar directory")
+    return resolved
+
+
+def _read_file(path):
+    with open(path, 'rb') as f:
+        return f.read(MAX_AVATAR_BYTES + 1)
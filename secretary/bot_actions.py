@@ -0,0 +1,57 @@
+def room_actions(room_policy):
+    # rooms list their bot actions either as 'bot_actions' (dict, see schema) or as 'actions' (list)
+    if 'bot_actions' in room_policy:
+        yield from room_policy['bot_actions'].values()
+    if 'actions' in room_policy:
+        yield from room_policy['actions']
+
+
+def expand_bot_actions(policy_bot_actions, room_policy):
+    # Returns the (bots, command) pairs of a room with templated commands formatted and sub_bot_actions expanded.
+    # bots is a tuple of the template's bot ids, commands are sent once to the room for all of them.
+    commands = []
+    for action in room_actions(room_policy):
+        _expand(policy_bot_actions, action['template'], _action_arguments(action, {}), commands, ())
+    return commands
+
+
+def used_templates(policy_bot_actions, template_name):
+    # The template and all templates reachable through its sub_bot_actions, unknown and circular ones are skipped
+    found = set()
+    stack = [template_name]
+    while stack:
+        name = stack.pop()
+        if name in found:
+            continue
+        found.add(name)
+        template = policy_bot_actions[name] if name in policy_bot_actions else {}
+        sub_actions = template['sub_bot_actions'] if 'sub_bot_actions' in template else []
+        stack.extend(sub_action['template']
+                     for sub_action in (sub_actions.values() if isinstance(sub_actions, dict) else sub_actions))
+    return found
+
+
+def _expand(policy_bot_actions, template_name, arguments, commands, path):
+    if template_name in path:
+        raise ValueError(f"Circular sub_bot_actions: {' -> '.join(path + (template_name,))}")
+    if template_name not in policy_bot_actions:
+        raise ValueError(f"Not a valid bot action template: \"{template_name}\"")
+    template = policy_bot_actions[template_name]
+    bots = tuple(template['bots']) if 'bots' in template else ()
+    for cmd in template['commands'] if 'commands' in template else []:
+        try:
+            command = (bots, cmd.format_map(arguments))
+        except KeyError as err:
+            raise ValueError(f"Missing argument {err} for bot action template \"{template_name}\"")
+        if command not in commands:
+            commands.append(command)
+    sub_actions = template['sub_bot_actions'] if 'sub_bot_actions' in template else []
+    for sub_action in sub_actions.values() if isinstance(sub_actions, dict) else sub_actions:
+        _expand(policy_bot_actions, sub_action['template'], _action_arguments(sub_action, arguments), commands,
+                path + (template_name,))
+
+
+def _action_arguments(action, parent_arguments):
+    # 'arguments' (schema) or 'format' (older policies); values may refer to the parent action's arguments
+    arguments = action['arguments'] if 'arguments' in action else action.get('format', {})
+    return {**parent_arguments, **{k: str(v).format_map(parent_arguments) for k, v in arguments.items()}}
@@ -0,0 +1,53 @@
+import hashlib
+import json
+import zlib
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+# Stored policies start with a version byte naming the codec, followed by the encoded policy.
+# Version bytes are never reused, so old rows stay readable after the default codec changes.
+ZLIB_JSON = 1
+ZLIB_MSGPACK = 2
+
+CODEC_NAMES = {'zlib-json': ZLIB_JSON, 'zlib-msgpack': ZLIB_MSGPACK}
+
+
+def encode_policy(policy, codec='zlib-json', level=6) -> bytes:
+    if codec not in CODEC_NAMES:
+        raise ValueError(f"Unknown policy codec {codec}, use one of {', '.join(CODEC_NAMES)}")
+    version = CODEC_NAMES[codec]
+    if version == ZLIB_MSGPACK:
+        if msgpack is None:
+            raise ValueError("The zlib-msgpack policy codec needs the msgpack package")
+        data = msgpack.packb(policy, use_bin_type=True)
+    else:
+        data = json.dumps(policy, separators=(',', ':'), ensure_ascii=False).encode('utf-8')
+    return bytes([version]) + zlib.compress(data, level)
+
+
+def decode_policy(data):
+    # Rows written before the codec was introduced hold plain JSON text
+    if isinstance(data, str):
+        return json.loads(data)
+    data = bytes(data)
+    version, payload = data[0], data[1:]
+    if version == ZLIB_JSON:
+        return json.loads(zlib.decompress(payload).decode('utf-8'))
+    if version == ZLIB_MSGPACK:
+        if msgpack is None:
+            raise ValueError("Policy was stored with the zlib-msgpack codec, but msgpack is not installed")
+        return msgpack.unpackb(zlib.decompress(payload), raw=False)
+    raise ValueError(f"Unknown policy codec version {version}")
+
+
+def hash_policy(policy) -> str:
+    # Content address of a policy, independent of key order and codec
+    canonical = json.dumps(policy, sort_keys=True, separators=(',', ':'), ensure_ascii=False)
+    return hashlib.sha256(canonical.encode('utf-8')).hexdigest()
+
+
+def available_codecs():
+    return [name for name, version in CODEC_NAMES.items() if version != ZLIB_MSGPACK or msgpack is not None]
@@ -1,4 +1,10 @@
-from mautrix.util.async_db import UpgradeTable, Connection
+import json
+import time
+
+from mautrix.util.async_db import UpgradeTable, Connection, Scheme
+
+from secretary.codec import encode_policy, decode_policy, hash_policy
+from secretary.tracing import span
 
 # Database
 upgrade_table = UpgradeTable()
@@ -22,5 +28,151 @@ async def upgrade_v1(conn: Connection) -> None:
     )
 
 
+@upgrade_table.register(description="Reverse index of users to managed rooms")
+async def upgrade_v2(conn: Connection) -> None:
+    await conn.execute(
+        """CREATE TABLE user_rooms (
+            user_id          TEXT,
+            policy_key       TEXT,
+            room_key         TEXT,
+            matrix_room_id   TEXT,
+            power_level      INTEGER,
+            user_group       TEXT,
+            PRIMARY KEY (user_id, policy_key, room_key)
+        )""")
+    await conn.execute("CREATE INDEX user_rooms_user_group_idx ON user_rooms (user_group)")
+    await conn.execute("CREATE INDEX user_rooms_room_idx ON user_rooms (policy_key, room_key)")
+
+
+@upgrade_table.register(description="Ledger of bot action commands sent to rooms")
+async def upgrade_v3(conn: Connection) -> None:
+    await conn.execute(
+        """CREATE TABLE bot_action_ledger (
+            policy_key       TEXT,
+            matrix_room_id   TEXT,
+            bots             TEXT,
+            command          TEXT,
+            sent_at          BIGINT,
+            PRIMARY KEY (policy_key, matrix_room_id, bots, command)
+        )""")
+
+
+@upgrade_table.register(description="Rooms that failed in their last ensure run")
+async def upgrade_v4(conn: Connection) -> None:
+    await conn.execute(
+        """CREATE TABLE failed_rooms (
+            policy_key       TEXT,
+            room_key         TEXT,
+            phase            TEXT,
+            error            TEXT,
+            failed_at        BIGINT,
+            PRIMARY KEY (policy_key, room_key)
+        )""")
+
+
+@upgrade_table.register(description="Store policies in a compressed binary encoding")
+async def upgrade_v5(conn: Connection, scheme: Scheme) -> None:
+    # SQLite can't change a column's type, so the table is rebuilt and existing rows are re-encoded
+    blob_type = "BLOB" if scheme == Scheme.SQLITE else "BYTEA"
+    await conn.execute(
+        f"""CREATE TABLE policies_v5 (
+            policy_key        TEXT,
+            policy_data       {blob_type},
+            PRIMARY KEY (policy_key)
+        )""")
+    rows = await conn.fetch("SELECT policy_key, policy_json FROM policies")
+    q = "INSERT INTO policies_v5 (policy_key, policy_data) VALUES ($1, $2)"
+    await conn.executemany(q, [(row['policy_key'], encode_policy(json.loads(row['policy_json']))) for row in rows])
+    await conn.execute("DROP TABLE policies")
+    await conn.execute("ALTER TABLE policies_v5 RENAME TO policies")
+
+
+@upgrade_table.register(description="Policy version history")
+async def upgrade_v6(conn: Connection, scheme: Scheme) -> None:
+    # Versions point to content-addressed blobs, uploading the same policy again doesn't store it twice
+    blob_type = "BLOB" if scheme == Scheme.SQLITE else "BYTEA"
+    await conn.execute(
+        f"""CREATE TABLE policy_blobs (
+            policy_hash      TEXT,
+            policy_data      {blob_type},
+            PRIMARY KEY (policy_hash)
+        )""")
+    await conn.execute(
+        """CREATE TABLE policy_versions (
+            policy_key       TEXT,
+            version          INTEGER,
+            policy_hash      TEXT,
+            created_at       BIGINT,
+            ensured_at       BIGINT,
+            PRIMARY KEY (policy_key, version)
+        )""")
+    # existing policies become their first version, processed copies (__<key>) aren't versioned
+    now = int(time.time() * 1000)
+    for row in await conn.fetch("SELECT policy_key, policy_data FROM policies"):
+        if row['policy_key'].startswith('__'):
+            continue
+        policy_hash = hash_policy(decode_policy(row['policy_data']))
+        await conn.execute("INSERT INTO policy_blobs (policy_hash, policy_data) VALUES ($1, $2) "
+                           "ON CONFLICT (policy_hash) DO NOTHING", policy_hash, row['policy_data'])
+        await conn.execute("INSERT INTO policy_versions (policy_key, version, policy_hash, created_at) "
+                           "VALUES ($1, 1, $2, $3)", row['policy_key'], policy_hash, now)
+
+
+@upgrade_table.register(description="Leases for ensure runs shared between instances")
+async def upgrade_v7(conn: Connection) -> None:
+    await conn.execute(
+        """CREATE TABLE policy_leases (
+            policy_key       TEXT,
+            holder           TEXT,
+            expires_at       BIGINT,
+            PRIMARY KEY (policy_key)
+        )""")
+
+
+@upgrade_table.register(description="Uploaded room avatars by content hash")
+async def upgrade_v8(conn: Connection) -> None:
+    await conn.execute(
+        """CREATE TABLE avatar_cache (
+            content_hash     TEXT,
+            mxc_uri          TEXT,
+            created_at       BIGINT,
+            PRIMARY KEY (content_hash)
+        )""")
+
+
+class WriteBuffer:
+    """Collects writes and flushes them in a single transaction, one executemany per statement.
+
+    Statements are flushed in the order they were first added, so e.g. all buffered DELETEs run before the
+    INSERTs that follow them.
+    """
+
+    def __init__(self, database, checkpoint=50):
+        self.database = database
+        self.checkpoint = checkpoint
+        self.writes = {}
+        self.rooms_since_flush = 0
+
+    def add(self, query, *args):
+        self.writes.setdefault(query, []).append(args)
+
+    async def room_done(self):
+        # Flush every `checkpoint` rooms, so a crash loses little more than the rooms in flight
+        self.rooms_since_flush += 1
+        if self.rooms_since_flush >= self.checkpoint:
+            await self.flush()
+
+    async def flush(self):
+        self.rooms_since_flush = 0
+        if not self.writes:
+            return
+        writes, self.writes = self.writes, {}
+        with span('flush', cat='db', statements=len(writes), rows=sum(len(rows) for rows in writes.values())):
+            async with self.database.acquire() as conn:
+                async with conn.transaction():
+                    for query, rows in writes.items():
+                        await conn.executemany(query, rows)
+
+
 def get_upgrade_table():
     return upgrade_table
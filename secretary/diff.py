@@ -0,0 +1,65 @@
+from secretary.generators import iter_policy_rooms
+
+
+def diff_policies(old, new):
+    # Structural diff: top-level fields that changed and, per room, whether it was added, removed or which fields changed.
+    # Generated rooms are compared like static rooms, invitees and user groups down to single users.
+    diff = {}
+    fields = diff_fields({k: v for k, v in old.items() if k != 'rooms'},
+                         {k: v for k, v in new.items() if k != 'rooms'})
+    if 'user_groups' in fields:
+        fields['user_groups'] = diff_user_groups(old.get('user_groups', {}), new.get('user_groups', {}))
+    if fields:
+        diff['fields'] = fields
+    rooms = diff_rooms(dict(iter_policy_rooms(old)), dict(iter_policy_rooms(new)))
+    if rooms:
+        diff['rooms'] = rooms
+    return diff
+
+
+def diff_rooms(old_rooms, new_rooms):
+    diff = {}
+    for room_key in sorted(old_rooms.keys() | new_rooms.keys()):
+        if room_key not in new_rooms:
+            diff[room_key] = {'removed': old_rooms[room_key]}
+        elif room_key not in old_rooms:
+            diff[room_key] = {'added': new_rooms[room_key]}
+        elif old_rooms[room_key] != new_rooms[room_key]:
+            fields = diff_fields(old_rooms[room_key], new_rooms[room_key])
+            if 'invitees' in fields:
+                fields['invitees'] = diff_fields(old_rooms[room_key].get('invitees') or {},
+                                                 new_rooms[room_key].get('invitees') or {})
+            diff[room_key] = {'changed': fields}
+    return diff
+
+
+def diff_user_groups(old_groups, new_groups):
+    diff = {}
+    for group in sorted(old_groups.keys() | new_groups.keys()):
+        old_users = set(old_groups[group]['users']) if group in old_groups else set()
+        new_users = set(new_groups[group]['users']) if group in new_groups else set()
+        if old_groups.get(group) != new_groups.get(group):
+            diff[group] = {'added': sorted(new_users - old_users), 'removed': sorted(old_users - new_users)}
+    return diff
+
+
+def diff_fields(old, new):
+    return {key: {'old': old.get(key), 'new': new.get(key)}
+            for key in sorted(old.keys() | new.keys()) if old.get(key) != new.get(key)}
+
+
+def changed_room_keys(diff, graph):
+    # Room keys of the new policy (see PolicyGraph) that have to be reconciled to implement the diff.
+    # Returns None if a changed top-level field can't be narrowed down to rooms, i.e. the whole policy is affected.
+    room_keys = {room_key for room_key, change in diff.get('rooms', {}).items() if 'removed' not in change}
+    for field, change in diff.get('fields', {}).items():
+        if field == 'user_groups':
+            for group in change.keys():
+                room_keys |= graph.rooms_affected_by_field(f"user_groups.{group}")
+        elif field in ['default_room_settings', 'bot_actions']:
+            old, new = change['old'] or {}, change['new'] or {}
+            for name in diff_fields(old, new).keys():
+                room_keys |= graph.rooms_affected_by_field(f"{field}.{name}")
+        elif field not in ['room_generators', 'policy_key', 'schemaVersion']:
+            return None
+    return room_keys
@@ -0,0 +1,57 @@
+import asyncio
+
+# State events enforced when someone else changes them, mapped to the room policy field they implement
+ENFORCED_EVENT_TYPES = {
+    'm.room.power_levels': 'invitees',
+    'm.room.join_rules': 'join_rule',
+    'm.room.name': 'room_name',
+    'm.room.topic': 'topic',
+    'm.room.history_visibility': 'history_visibility',
+    'm.room.guest_access': 'guest_access',
+}
+
+
+class RoomIndex:
+    """Managed room id -> (policy key, room key), plus the compiled room policies of each policy once looked up."""
+
+    def __init__(self, rooms):
+        self.rooms = rooms
+        self.compiled = {}
+
+    def __contains__(self, room_id):
+        return room_id in self.rooms
+
+    def lookup(self, room_id):
+        policy_key, room_key = self.rooms[room_id]
+        return policy_key, room_key, self.compiled.get(policy_key)
+
+
+class Debouncer:
+    """Coalesces work per key: callback(key, items) runs once, `delay` seconds after the first item was scheduled.
+
+    Items scheduled while the callback runs start the next round.
+    """
+
+    def __init__(self, callback, delay=5.0):
+        self.callback = callback
+        self.delay = delay
+        self.pending = {}
+        self.tasks = {}
+
+    def schedule(self, key, item):
+        self.pending.setdefault(key, set()).add(item)
+        if key not in self.tasks:
+            self.tasks[key] = asyncio.create_task(self._run(key))
+
+    async def _run(self, key):
+        try:
+            await asyncio.sleep(self.delay)
+        finally:
+            self.tasks.pop(key, None)
+        await self.callback(key, self.pending.pop(key, set()))
+
+    def cancel(self):
+        for task in self.tasks.values():
+            task.cancel()
+        self.tasks = {}
+        self.pending = {}
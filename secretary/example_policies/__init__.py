@@ -0,0 +1,31 @@
+import importlib
+from importlib import resources
+
+# Example policies by policy key: (module, factory, kwargs).
+# Modules are only imported and policies only built when requested by name.
+EXAMPLE_POLICIES = {
+    'nina_small': ('nina', 'get_nina_policy', {'small': True}),
+    'nina': ('nina', 'get_nina_policy', {'small': False}),
+    'minimal_policy': ('minimal_policy', 'get_minimal_policy', {}),
+    'corner': ('corner_cases', 'get_corner_cases_policy', {}),
+    'synthetic': ('synthetic', 'get_synthetic_policy', {'policy_key': 'synthetic'}),
+}
+# Large policies that are only loaded when asked for by name, not with all example policies
+ON_REQUEST_ONLY = {'synthetic'}
+
+
+def get_example_policy_keys():
+    return [policy_key for policy_key in EXAMPLE_POLICIES if policy_key not in ON_REQUEST_ONLY]
+
+
+def get_example_policy(policy_key):
+    if policy_key not in EXAMPLE_POLICIES:
+        raise KeyError(f"No example policy named {policy_key}")
+    module_name, factory, kwargs = EXAMPLE_POLICIES[policy_key]
+    module = importlib.import_module(f"{__name__}.{module_name}")
+    return getattr(module, factory)(**kwargs)
+
+
+def open_data_file(file_name):
+    # Data files are shipped as package data, so this also works from a zipped plugin
+    return resources.files(__name__).joinpath('data', file_name).open('r', encoding='utf-8')
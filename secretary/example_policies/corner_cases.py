@@ -1,7 +1,3 @@
-import itertools
-import random
-
-
 def get_corner_cases_policy():
     policy = {}
 
@@ -36,6 +32,19 @@ def get_corner_cases_policy():
             },
         },
     }
+    policy["rooms"]["Corner Case Room empty topic"] = {
+        "room_name": "Room with empty topic",
+        "topic": '',
+        "invitees": {
+            "all": 100,
+        },
+    }
+    policy["rooms"]["Corner Case Room no topic"] = {
+        "room_name": "Room without topic",
+        "invitees": {
+            "all": 100,
+        },
+    }
     legal_dict = {
         'guest_access': ['can_join', 'forbidden'],
         'history_visibility': ['shared', 'invited', 'joined', 'world_readable'],
@@ -43,25 +52,20 @@ def get_corner_cases_policy():
         'visibility': ['public', 'private'],
     }
 
-    combinations = list(itertools.product(*legal_dict.values()))
     # Add all possible combinations of legal values for the room settings
-    room_names = ['Room ' + str(i + 1) for i in range(len(combinations))]
-    topics = ['This is a test_room', '', 'Yeah, whatever...', 'Beep Boop Dev Room', None]
-    topics = topics * (len(combinations) // len(topics) + 1)
-
-    random.shuffle(room_names)
-    for combination, name, topic in zip(combinations, room_names, topics):
-        room = {
-            "room_name": name,
-            "invitees": {
-                "all": 100,
+    policy["room_generators"] = {
+        "combinations": {
+            "source": {"type": "product", "columns": legal_dict},
+            "room_key": "Corner Case Room ('{guest_access}', '{history_visibility}', '{join_rule}', '{visibility}')",
+            "template": {
+                "room_name": "Room {_index}",
+                "topic": "Beep Boop Dev Room",
+                "invitees": {
+                    "all": 100,
+                },
+                **{key: '{' + key + '}' for key in legal_dict.keys()},
             },
-        }
-        if topic is not None:
-            room['topic'] = topic
-        for key, value in zip(legal_dict.keys(), combination):
-            room[key] = value
-        policy["rooms"]["Corner Case Room " + str(combination)] = room
+        },
+    }
 
     return policy
-
@@ -109,6 +109,13 @@ SCHEMA = """
               "format": "matrix-room"
             }
           },
+          "allow_spaces": {
+            "description": "Spaces (besides the parent spaces) whose members may join the room if its join rule is restricted.",
+            "type": "array",
+            "items": {
+              "type": "string"
+            }
+          },
           "topic": {
             "description": "The topic of the room.",
             "type": "string"
@@ -157,10 +164,9 @@ SCHEMA = """
               "m.room"
             ]
           },
-          "avatar_url": {
-            "description": "The avatar URL of the room.",
-            "type": "string",
-            "format": "uri"
+          "room_avatar": {
+            "description": "The avatar of the room, an mxc:// URI, an http(s) URL or a local file.",
+            "type": "string"
           },
           "bot_actions": {
             "type": "object",
@@ -185,6 +191,85 @@ SCHEMA = """
         }
       }
     },
+    "removed_rooms": {
+      "description": "What happens to rooms that were removed from the policy on the next full ensure run.",
+      "type": "string",
+      "enum": [
+        "keep",
+        "unlink",
+        "archive",
+        "delete"
+      ]
+    },
+    "max_space_children": {
+      "description": "Maximum number of direct children per space. Larger spaces get alphabetical sub-spaces in between.",
+      "type": "integer",
+      "minimum": 2
+    },
+    "room_generators": {
+      "description": "Templates that generate rooms lazily from a tabular data source.",
+      "type": "object",
+      "additionalProperties": {
+        "type": "object",
+        "properties": {
+          "source": {
+            "description": "The data source, rows are formatted into room_key and template.",
+            "type": "object",
+            "properties": {
+              "type": {
+                "type": "string",
+                "enum": [
+                  "csv",
+                  "product"
+                ]
+              },
+              "resource": {
+                "description": "CSV file shipped with secretary/example_policies/data.",
+                "type": "string"
+              },
+              "path": {
+                "description": "CSV file in the data directory (data_dir in the plugin config), relative to it.",
+                "type": "string"
+              },
+              "columns": {
+                "description": "CSV column names (if the file has no header) or value lists for 'product'."
+              },
+              "delimiter": {
+                "type": "string"
+              },
+              "filter": {
+                "description": "Only use rows whose columns equal these values.",
+                "type": "object"
+              },
+              "distinct": {
+                "description": "Only use the first row for every value of this column.",
+                "type": "string"
+              },
+              "limit": {
+                "type": "integer",
+                "minimum": 0
+              }
+            },
+            "required": [
+              "type"
+            ]
+          },
+          "room_key": {
+            "description": "Format string for the room key, e.g. '{name}'.",
+            "type": "string"
+          },
+          "template": {
+            "description": "A room definition, all strings are formatted with the row's columns.",
+            "type": "object"
+          }
+        },
+        "required": [
+          "source",
+          "room_key",
+          "template"
+        ]
+      }
+    },
     "bot_actions": {
       "type": "object",
       "additionalProperties": {
@@ -0,0 +1,101 @@
+import argparse
+import json
+import random
+
+
+def get_synthetic_policy(rooms=1000, depth=3, fan_out=10, user_groups=5, group_size=20, invitees=5, aliases=True,
+                         bot_actions=0.1, seed=0, policy_key=None, server='example.org'):
+    """Builds a valid policy of a given size for scale tests, the same arguments always build the same policy.
+
+    Spaces form a tree of `depth` levels with up to `fan_out` children each, the remaining rooms are spread over the
+    spaces of the deepest level. Every room invites one user group and `invitees` users directly, `bot_actions` is
+    the share of rooms subscribing to a feed.
+    """
+    rng = random.Random(seed)
+    # users overlap between groups and rooms, like in real organisations
+    users = [f"@synthetic_user_{i}:{server}" for i in range(max(user_groups * group_size // 2, invitees, 1))]
+    groups = {f"group_{g}": {"users": sorted(rng.sample(users, min(group_size, len(users))))}
+              for g in range(user_groups)}
+
+    room_policies = {}
+    # one root space, then fan_out children per space on every further level
+    level = [None]
+    for _ in range(depth):
+        next_level = []
+        for parent in level:
+            for _ in range(1 if parent is None else fan_out):
+                if len(room_policies) >= rooms:
+                    break
+                room_key = f"space_{len(room_policies)}"
+                room_policies[room_key] = _room(rng, room_key, parent, True, groups, users, invitees, aliases)
+                next_level.append(room_key)
+        if not next_level:
+            break
+        level = next_level
+    leaves = level
+    for i in range(rooms - len(room_policies)):
+        room_key = f"room_{i}"
+        room_policies[room_key] = _room(rng, room_key, leaves[i % len(leaves)], False, groups, users, invitees,
+                                        aliases)
+        if rng.random() < bot_actions:
+            room_policies[room_key]['bot_actions'] = {
+                "feed": {"template": "rss", "arguments": {"link": f"https://{server}/feeds/{room_key}.rss"}}}
+
+    return {
+        "schemaVersion": 1,
+        "policy_key": policy_key or f"synthetic_{rooms}_{seed}",
+        "policy_description": f"Synthetic policy: {rooms} rooms, depth {depth}, fan-out {fan_out}, "
+                              f"{user_groups} user groups of {group_size} users, seed {seed}.",
+        "default_room_settings": {
+            "visibility": "private",
+            "guest_access": "forbidden",
+            "history_visibility": "shared",
+            "join_rule": "restricted",
+        },
+        "user_groups": groups,
+        "bot_actions": {
+            "rss": {
+                "bots": [f"@bot.rss:{server}"],
+                "commands": ["!rss subscribe {link}"],
+            }},
+        "rooms": room_policies,
+    }
+
+
+def _room(rng, room_key, parent, is_space, groups, users, invitees, aliases):
+    room_policy = {
+        "room_name": room_key.replace('_', ' ').title(),
+        "topic": f"Synthetic {'space' if is_space else 'room'} {room_key}",
+        "is_space": is_space,
+        "invitees": {user: rng.choice([0, 0, 0, 50, 100]) for user in rng.sample(users, min(invitees, len(users)))},
+    }
+    if groups:
+        room_policy['invitees'][rng.choice(sorted(groups))] = 0
+    if parent:
+        room_policy['parent_spaces'] = [parent]
+    if aliases:
+        room_policy['alias'] = f"synthetic_{room_key}"
+    return room_policy
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Print a synthetic policy as JSON")
+    parser.add_argument('--rooms', type=int, default=1000)
+    parser.add_argument('--depth', type=int, default=3)
+    parser.add_argument('--fan-out', type=int, default=10)
+    parser.add_argument('--groups', type=int, default=5)
+    parser.add_argument('--group-size', type=int, default=20)
+    parser.add_argument('--invitees', type=int, default=5)
+    parser.add_argument('--no-aliases', action='store_true')
+    parser.add_argument('--bot-actions', type=float, default=0.1)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--key')
+    args = parser.parse_args()
+    print(json.dumps(get_synthetic_policy(rooms=args.rooms, depth=args.depth, fan_out=args.fan_out,
+                                          user_groups=args.groups, group_size=args.group_size,
+                                          invitees=args.invitees, aliases=not args.no_aliases,
+                                          bot_actions=args.bot_actions, seed=args.seed, policy_key=args.key)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,45 @@
+import io
+import json
+import zlib
+
+CHUNK_SIZE = 64 * 1024
+
+
+def iter_json_bytes(obj, compress=False, sort_keys=False):
+    # Serializes obj piece by piece and yields utf-8 (optionally gzipped) chunks of roughly CHUNK_SIZE bytes.
+    # Compressed exports are written compact, they aren't meant to be read in a chat client anyway.
+    encoder = json.JSONEncoder(indent=None if compress else 4, sort_keys=sort_keys, ensure_ascii=False,
+                               separators=(',', ':') if compress else None)
+    compressor = zlib.compressobj(wbits=zlib.MAX_WBITS | 16) if compress else None
+    pending = []
+    pending_size = 0
+    for piece in encoder.iterencode(obj):
+        pending.append(piece)
+        pending_size += len(piece)
+        if pending_size >= CHUNK_SIZE:
+            data = ''.join(pending).encode('utf-8')
+            pending, pending_size = [], 0
+            data = compressor.compress(data) if compressor else data
+            if data:
+                yield data
+    data = ''.join(pending).encode('utf-8')
+    if compressor:
+        data = compressor.compress(data) + compressor.flush()
+    if data:
+        yield data
+
+
+def encode_json(obj, compress=False, sort_keys=False) -> bytes:
+    # The media upload needs the full size up front, so chunks are collected in a single bytes buffer
+    buffer = io.BytesIO()
+    for chunk in iter_json_bytes(obj, compress=compress, sort_keys=sort_keys):
+        buffer.write(chunk)
+    return buffer.getvalue()
+
+
+def export_file_name(name, compress=False):
+    return f"{name}.json.gz" if compress else f"{name}.json"
+
+
+def export_mime_type(compress=False):
+    return "application/gzip" if compress else "application/json"
@@ -0,0 +1,109 @@
+import unicodedata
+
+from secretary.util import get_logger
+
+# Bucket boundaries are fixed ranges of this alphabet, other characters count as '#'
+ALPHABET = '#0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZ'
+# Buckets are split by up to this many leading characters of the room keys
+MAX_PREFIX_LENGTH = 3
+
+
+def iter_limited_rooms(iter_rooms, max_children):
+    # Spaces with more than max_children children get alphabetical bucket sub-spaces ("Bayern [A–D]") in between,
+    # overfull buckets get sub-buckets of their own ("Bayern [A]" in "Bayern [A–D]").
+    # iter_rooms() is called twice: children are counted first, then rooms are yielded with their parents rewritten
+    # and the bucket spaces last.
+    children = {}
+    spaces = {}
+    for room_key, room_policy in iter_rooms():
+        for parent in _parents(room_policy):
+            children.setdefault(parent, []).append(room_key)
+        if room_policy.get('is_space'):
+            spaces[room_key] = room_policy
+
+    bucket_of = {}
+    buckets = {}
+    for parent, child_keys in children.items():
+        if len(child_keys) > max_children:
+            for label, (outer_label, members) in bucket_children(child_keys, max_children).items():
+                outer = parent if outer_label is None else f"{parent} [{outer_label}]"
+                buckets[f"{parent} [{label}]"] = (parent, label, outer)
+                for child_key in members:
+                    bucket_of[(parent, child_key)] = f"{parent} [{label}]"
+
+    for room_key, room_policy in iter_rooms():
+        moved = [parent for parent in _parents(room_policy) if (parent, room_key) in bucket_of]
+        if moved:
+            room_policy = dict(room_policy)
+            # members of the original parent can still join restricted rooms directly
+            room_policy['allow_spaces'] = room_policy.get('allow_spaces', []) + \
+                [parent for parent in moved if parent in room_policy.get('parent_spaces', [])]
+            for field in ['parent_spaces', 'parent_spaces_silent']:
+                if field in room_policy:
+                    room_policy[field] = [bucket_of.get((parent, room_key), parent) for parent in room_policy[field]]
+        yield room_key, room_policy
+
+    for bucket_key, (parent, label, outer) in buckets.items():
+        parent_policy = spaces.get(parent, {})
+        yield bucket_key, {
+            'room_name': f"{parent_policy.get('room_name', parent)} {label}",
+            'is_space': True,
+            'parent_spaces': [outer],
+            'invitees': dict(parent_policy.get('invitees', {})),
+        }
+
+
+def bucket_children(child_keys, max_children):
+    # {label: (label of the enclosing bucket or None, child keys)}. Bucket boundaries are fixed ranges of ALPHABET
+    # that only depend on max_children, so a new room only moves rooms if its bucket overflows and gets split.
+    # Only non-empty buckets are returned, enclosing buckets have no child keys of their own.
+    buckets = {}
+    _split(sorted(set(child_keys), key=str.casefold), max_children, '', 0, len(ALPHABET), None, buckets)
+    return buckets
+
+
+def _split(keys, max_children, prefix, lo, hi, outer_label, buckets):
+    # keys share prefix and have their next character in ALPHABET[lo:hi]
+    for range_lo, range_hi in _ranges(lo, hi, max_children):
+        members = [k for k in keys if range_lo <= _symbol(k, len(prefix)) < range_hi]
+        if not members:
+            continue
+        label = _label(prefix, range_lo, range_hi)
+        if len(members) <= max_children:
+            buckets[label] = (outer_label, members)
+        elif range_hi - range_lo > 1:
+            buckets[label] = (outer_label, [])
+            _split(members, max_children, prefix, range_lo, range_hi, label, buckets)
+        elif len(prefix) + 1 < MAX_PREFIX_LENGTH:
+            buckets[label] = (outer_label, [])
+            _split(members, max_children, prefix + ALPHABET[range_lo], 0, len(ALPHABET), label, buckets)
+        else:
+            # longer prefixes aren't split any further
+            get_logger().warning("%s rooms start with %s, their bucket exceeds %s children",
+                                 len(members), label, max_children)
+            buckets[label] = (outer_label, members)
+
+
+def _ranges(lo, hi, max_children):
+    # ALPHABET[lo:hi] in at most max_children contiguous ranges of (nearly) equal size
+    count = max(2, min(max_children, hi - lo))
+    bounds = [lo + (hi - lo) * i // count for i in range(count + 1)]
+    return [(a, b) for a, b in zip(bounds, bounds[1:]) if a < b]
+
+
+def _label(prefix, lo, hi):
+    if hi - lo == 1:
+        return prefix + ALPHABET[lo]
+    return f"{prefix}{ALPHABET[lo]}–{prefix}{ALPHABET[hi - 1]}"
+
+
+def _symbol(key, position):
+    # Index of the key's character at position in ALPHABET, accents are dropped ('Ä' -> 'A')
+    if position >= len(key):
+        return 0
+    char = unicodedata.normalize('NFKD', key[position])[:1].upper()
+    return max(ALPHABET.find(char), 0)
+
+
+def _parents(room_policy):
+    return room_policy.get('parent_spaces', []) + room_policy.get('parent_spaces_silent', [])
@@ -0,0 +1,98 @@
+import csv
+import itertools
+
+from secretary.example_policies import open_data_file
+from secretary.fanout import iter_limited_rooms
+from secretary.util import get_logger, confined_path
+
+# Directory csv sources given by 'path' are read from, set from the plugin config. None disables them
+data_dir = None
+
+
+def iter_policy_rooms(policy):
+    # Static rooms first, then the rooms of every generator, one room at a time.
+    # With max_space_children set, overfull spaces get bucket sub-spaces (see fanout.py)
+    if policy.get('max_space_children'):
+        yield from iter_limited_rooms(lambda: _iter_rooms(policy), policy['max_space_children'])
+    else:
+        yield from _iter_rooms(policy)
+
+
+def _iter_rooms(policy):
+    # Room keys are unique, if a generator yields a key again only its first room is used.
+    seen = set(policy['rooms'].keys()) if 'rooms' in policy else set()
+    if 'rooms' in policy:
+        yield from policy['rooms'].items()
+    for generator in policy.get('room_generators', {}).values():
+        for room_key, room_policy in iter_generated_rooms(generator):
+            if room_key in seen:
+                get_logger().warning("Room key %s is generated again, only its first room is used", room_key)
+                continue
+            seen.add(room_key)
+            yield room_key, room_policy
+
+
+def iter_generated_rooms(generator):
+    for row in iter_source_rows(generator['source']):
+        yield render_template(generator['room_key'], row), render_template(generator['template'], row)
+
+
+def iter_source_rows(source):
+    if source['type'] == 'csv':
+        rows = _iter_csv_rows(source)
+    elif source['type'] == 'product':
+        rows = (dict(zip(source['columns'].keys(), values))
+                for values in itertools.product(*source['columns'].values()))
+    else:
+        raise ValueError(f"Not a valid room generator source type: \"{source['type']}\"")
+
+    if 'filter' in source:
+        rows = (row for row in rows if all(row.get(k) == v for k, v in source['filter'].items()))
+    if 'distinct' in source:
+        rows = _distinct(rows, source['distinct'])
+    if 'limit' in source:
+        rows = itertools.islice(rows, source['limit'])
+    for index, row in enumerate(rows, start=1):
+        row['_index'] = index
+        yield row
+
+
+def render_template(template, row):
+    # Returns a fresh copy of the template with all strings formatted with the row's columns
+    if isinstance(template, str):
+        return template.format_map(row)
+    if isinstance(template, dict):
+        return {k: render_template(v, row) for k, v in template.items()}
+    if isinstance(template, list):
+        return [render_template(v, row) for v in template]
+    return template
+
+
+def _iter_csv_rows(source):
+    # 'resource' refers to package data of secretary/example_policies, 'path' to a file in data_dir
+    if 'resource' in source:
+        f = open_data_file(source['resource'])
+    elif 'path' in source:
+        f = open(data_path(source['path']), 'r', encoding='utf-8', newline='')
+    else:
+        raise ValueError("A csv room generator source needs either a 'resource' or a 'path'")
+    with f:
+        yield from csv.DictReader(f, fieldnames=source.get('columns'), delimiter=source.get('delimiter', ','))
+
+
+def data_path(path):
+    # Paths are relative to data_dir, anything resolving outside of it is refused
+    if not data_dir:
+        raise ValueError(f"CSV source {path} is a local file, but no data directory is configured")
+    resolved = confined_path(path, data_dir)
+    if resolved is None:
+        raise ValueError(f"CSV source {path} is outside of the data directory")
+    return resolved
+
+
+def _distinct(rows, column):
+    seen = set()
+    for row in rows:
+        if row[column] not in seen:
+            seen.add(row[column])
+            yield row
@@ -0,0 +1,80 @@
+from secretary.bot_actions import room_actions, used_templates
+from secretary.generators import iter_policy_rooms
+
+
+class PolicyGraph:
+    """In-memory index over a policy's rooms: space hierarchy, user group usage and which rooms set which field.
+
+    Only room keys are kept, so the index stays small even for generated policies.
+    """
+
+    def __init__(self, policy):
+        self.room_keys = []
+        self.children = {}
+        self.parents = {}
+        self.group_rooms = {}
+        self.template_rooms = {}
+        self.field_rooms = {}
+        self._known = set()
+        self._bot_actions = policy['bot_actions'] if 'bot_actions' in policy else {}
+        self._used_templates = {}
+        for room_key, room_policy in iter_policy_rooms(policy):
+            self.add_room(room_key, room_policy)
+
+    def add_room(self, room_key, room_policy):
+        self.room_keys.append(room_key)
+        self._known.add(room_key)
+        for field in room_policy.keys():
+            self.field_rooms.setdefault(field, set()).add(room_key)
+        for parent_key in room_policy.get('parent_spaces', []) + room_policy.get('parent_spaces_silent', []):
+            self.children.setdefault(parent_key, set()).add(room_key)
+            self.parents.setdefault(room_key, set()).add(parent_key)
+        for invitee in room_policy.get('invitees', {}).keys():
+            if not invitee.startswith('@'):
+                self.group_rooms.setdefault(invitee, set()).add(room_key)
+        for action in room_actions(room_policy):
+            # rooms are affected by changes of sub-templates too
+            if action['template'] not in self._used_templates:
+                self._used_templates[action['template']] = used_templates(self._bot_actions, action['template'])
+            for template_name in self._used_templates[action['template']]:
+                self.template_rooms.setdefault(template_name, set()).add(room_key)
+
+    def __contains__(self, room_key):
+        return room_key in self._known
+
+    def descendants(self, room_key):
+        return self._walk(room_key, self.children)
+
+    def ancestors(self, room_key):
+        return self._walk(room_key, self.parents)
+
+    def subtree(self, room_key):
+        return {room_key} | self.descendants(room_key)
+
+    def rooms_using_group(self, group):
+        return set(self.group_rooms.get(group, set()))
+
+    def rooms_affected_by_field(self, field):
+        # field is either a room field ('topic'), or a dotted policy-level path such as
+        # 'default_room_settings.join_rule', 'user_groups.<group>' or 'bot_actions.<template>'
+        section, _, name = field.partition('.')
+        if section == 'default_room_settings' and name:
+            return set(self.room_keys) - self.field_rooms.get(name, set())
+        if section == 'user_groups' and name:
+            return self.rooms_using_group(name)
+        if section == 'bot_actions' and name:
+            return set(self.template_rooms.get(name, set()))
+        return set(self.field_rooms.get(field, set()))
+
+    @staticmethod
+    def _walk(room_key, edges):
+        # iterative, circular spaces are allowed in policies
+        found = set()
+        stack = [room_key]
+        while stack:
+            for k in edges.get(stack.pop(), set()):
+                if k not in found and k != room_key:
+                    found.add(k)
+                    stack.append(k)
+        return found
+
@@ -0,0 +1,56 @@
+import cProfile
+import io
+import marshal
+import pstats
+import time
+import tracemalloc
+
+
+class ProfilerBusyError(Exception):
+    pass
+
+
+_active = False
+
+
+async def profile_call(coro_factory, top=15):
+    """Awaits coro_factory() under cProfile with tracemalloc enabled.
+
+    cProfile is deterministic and sees everything the event loop runs meanwhile, not only the profiled coroutine.
+    Returns the stats (marshalled, loadable with pstats or snakeviz) and a summary of the top CPU and allocation
+    hotspots. Only one profile runs at a time.
+    """
+    global _active
+    if _active:
+        raise ProfilerBusyError("Another profile is running")
+    _active = True
+    started_tracemalloc = not tracemalloc.is_tracing()
+    if started_tracemalloc:
+        tracemalloc.start()
+    tracemalloc.reset_peak()
+    before = tracemalloc.take_snapshot()
+    profiler = cProfile.Profile()
+    start = time.perf_counter()
+    try:
+        profiler.enable()
+        try:
+            await coro_factory()
+        finally:
+            profiler.disable()
+        elapsed = time.perf_counter() - start
+        after = tracemalloc.take_snapshot()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        if started_tracemalloc:
+            tracemalloc.stop()
+        _active = False
+
+    summary = io.StringIO()
+    stats = pstats.Stats(profiler, stream=summary)
+    summary.write(f"Wall time {elapsed:.2f}s, peak traced memory {peak / 1024 / 1024:.1f} MiB\n\n")
+    summary.write(f"Top {top} functions by cumulative time:\n")
+    stats.sort_stats('cumulative').print_stats(top)
+    summary.write(f"Top {top} allocation sites (net growth):\n")
+    for stat in after.compare_to(before, 'lineno')[:top]:
+        summary.write(f"  {stat}\n")
+    return marshal.dumps(stats.stats), summary.getvalue()
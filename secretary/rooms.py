@@ -3,8 +3,9 @@ import re
 
 from mautrix.api import Method, Path
 from mautrix.errors import MForbidden
+from mautrix.types import EventType
 
-from secretary.util import get_logger
+from secretary.util import get_logger, AdminAPIUnavailableError
 
 
 async def create_room(client,
@@ -13,6 +14,7 @@ async def create_room(client,
                       is_space=False,
                       topic=None,
                       logger=None,
+                      admin=None,
                       ):
     if not logger:
         logger = get_logger()
@@ -23,13 +25,17 @@ async def create_room(client,
     if not topic:
         topic = "No topic set."
     if len(invitees) == 0:
-        logger.warn('There are no invitees - this room will not be very useful like this.')
+        logger.warning('There are no invitees - this room will not be very useful like this.')
 
-    pl_override = {"users": {client.mxid: 9001}}
+    pl_override = {"users": {client.mxid: 9001 if not admin else 100}}
     for u, pl in invitees.items():
         pl_override["users"][str(u)] = int(pl)
+    if admin:
+        # a helper account creates the room, the admin (primary bot) is invited and gets full power
+        pl_override["users"][admin] = 9001
+        invitees = {**invitees, admin: 9001}
 
-    logger.debug(f"creating room {room_name} with invitees {invitees} and power levels {pl_override}...")
+    logger.debug("creating room %s with invitees %s and power levels %s...", room_name, invitees, pl_override)
     room_id = await client.create_room(name=room_name,
                                        topic=topic,
                                        invitees=[str(k) for k in invitees.keys()],
@@ -39,8 +45,23 @@ async def create_room(client,
     return room_id
 
 
-async def delete_room(client, room):
-    # kick users, delete aliases, delete room
+async def hand_over_room(client, admin, room_id):
+    # The helper account that created a room drops its power level and leaves, the admin (primary bot) keeps the room
+    power_levels = await admin.get_state_event(room_id, EventType.ROOM_POWER_LEVELS)
+    if client.mxid in power_levels.users:
+        del power_levels.users[client.mxid]
+        await admin.send_state_event(room_id, EventType.ROOM_POWER_LEVELS, power_levels)
+    await client.leave_room(room_id)
+
+
+async def delete_room(client, room, admin_api=None):
+    # with the admin API, one call deletes and purges the room; otherwise kick users, delete aliases, leave room
+    if admin_api is not None and admin_api.available:
+        try:
+            await admin_api.delete_room(room, purge=True)
+            return
+        except AdminAPIUnavailableError:
+            pass
     await _delete_aliases(client, room)
     await _kick_all_users(client, room)
     await client.leave_room(room_id=room)
@@ -1,26 +1,68 @@
+import asyncio
 import json
 import logging
+import time
+import uuid
+from contextlib import asynccontextmanager
 
 from mautrix.api import Method
-from mautrix.errors import MForbidden, MNotFound
+from mautrix.errors import MForbidden, MNotFound, MatrixRequestError
 from mautrix.types import RoomAvatarStateEventContent, Membership, EventType
 
 from secretary import create_room
-from secretary.rooms import delete_room
-from secretary.util import get_example_policies, get_logger, DatabaseEntryNotFoundException, escape_as_alias, \
-    is_matrix_room_id, is_matrix_room_alias, is_legal, PolicyNotFoundError, log_error
+from secretary.admin_api import SynapseAdminAPI
+from secretary.rooms import delete_room, hand_over_room
+from secretary.spaces import get_space_children, diff_space_children, child_event_content, \
+    parent_event_content
+from secretary.accounts import AccountPool
+from secretary.avatars import is_mxc, content_hash, load_image
+from secretary.codec import encode_policy, decode_policy, hash_policy
+from secretary.diff import diff_policies, changed_room_keys
+from secretary.enforcement import ENFORCED_EVENT_TYPES, RoomIndex, Debouncer
+from secretary.tracing import TracedDatabase, span, traced
+from secretary.database import WriteBuffer
+from secretary.bot_actions import expand_bot_actions, room_actions
+from secretary.example_policies import get_example_policy, get_example_policy_keys
+from secretary.example_policies.synthetic import get_synthetic_policy
+from secretary.generators import iter_policy_rooms
+from secretary.graph import PolicyGraph
+from secretary.util import get_logger, DatabaseEntryNotFoundException, escape_as_alias, \
+    is_matrix_room_id, is_matrix_room_alias, is_legal, PolicyNotFoundError, log_error, gather_bounded, \
+    run_context, AdminAPIUnavailableError, PolicyLockedError, UserNotFoundError, BotActionsPostponedError
 
 
 class MatrixSecretary:
 
     def __init__(self, client, db):
-        self.client = client
-        self.database = db
+        # all requests go through the account pool's rate budgets, self.client is the primary bot account
+        self.accounts = AccountPool(client)
+        self.client = self.accounts.primary
+        self.database = TracedDatabase(db)
         self.mxid = self.client.mxid
         self.verbose = 'debug'
+        self.max_concurrency = 10
+        self.db_checkpoint = 50
+        self.policy_codec = 'zlib-json'
+        self.admin_api = None
+        self.room_index = None
+        # avatar source -> task resolving it to an mxc URI, every image is loaded at most once per ensure run
+        self.avatar_uploads = {}
+        self.avatar_dir = None
+        self.bot_join_timeout = 30
+        # single-flight: running ensure tasks by (policy key, room keys), one lock per policy, our lease holder id
+        self.in_flight = {}
+        self.policy_locks = {}
+        self.lease_holder = f"{self.mxid}/{uuid.uuid4().hex[:8]}"
+        self.lease_ttl = 60
+        self.lease_wait = 600
+        self.enforcer = Debouncer(self.enforce_room)
         self.notice_room = None
         self.logger = get_logger(stream_level=logging.DEBUG if self.verbose == 'debug' else logging.INFO)
 
+    def set_admin_api(self, base_url, access_token, client_session=None):
+        # Without an access token everything goes through the client API
+        self.admin_api = SynapseAdminAPI(base_url, access_token, client_session) if access_token else None
+
     async def set_notice_room(self, room_id) -> str:
         if self.notice_room == room_id:
             return f"This room is already set as maintenance room for this session ({room_id})."
@@ -43,56 +85,348 @@ class MatrixSecretary:
             await self.ensure_policy(p)
         pass
 
-    async def ensure_policy(self, policy_key):
+    async def ensure_policy(self, policy_key, room_keys=None):
+        # Returns the rooms that failed, {room_key: (phase, error)}, all other rooms are implemented.
+        # A request covered by a running one (a full run, or one reconciling all requested rooms) joins it and gets
+        # its result for the requested rooms, other runs of the policy wait for it.
+        requested = None if room_keys is None else frozenset(room_keys)
+        flight = self._covering_flight(policy_key, requested)
+        if flight is not None:
+            self.logger.info("Joining the running ensure of %s", policy_key)
+        else:
+            flight = (policy_key, requested)
+            task = asyncio.ensure_future(self._ensure_policy_exclusive(policy_key, room_keys))
+            self.in_flight[flight] = task
+            task.add_done_callback(lambda _: self.in_flight.pop(flight, None))
+        # a cancelled request doesn't cancel the run others may be waiting for
+        failures = await asyncio.shield(self.in_flight[flight])
+        if requested is None or flight[1] == requested:
+            return failures
+        return {room_key: failure for room_key, failure in failures.items() if room_key in requested}
+
+    def _covering_flight(self, policy_key, requested):
+        if (policy_key, requested) in self.in_flight:
+            return policy_key, requested
+        for key, scope in self.in_flight:
+            if key == policy_key and (scope is None or (requested is not None and requested <= scope)):
+                return key, scope
+        return None
+
+    async def _ensure_policy_exclusive(self, policy_key, room_keys):
+        with run_context(f"ensure:{policy_key}"):
+            async with self._policy_lock(policy_key):
+                # versions are read before the policy, so a version added meanwhile is never marked as ensured
+                versions = await self._get_policy_versions_from_db(policy_key)
+                return await self._ensure_locked(policy_key, room_keys,
+                                                 versions[-1]['version'] if room_keys is None and versions else None)
+
+    async def _ensure_locked(self, policy_key, room_keys, version=None):
+        # Runs with the policy lock held, version is marked as ensured if all rooms were implemented
+        failures = await self._ensure_policy(policy_key, room_keys=room_keys)
+        self.room_index = None
+        self.avatar_uploads = {}
+        if version is not None and not failures:
+            await self._mark_policy_version_ensured(policy_key, version)
+        return failures
+
+    async def ensure_changed(self, policy_key):
+        # Reconciles only the rooms affected by the changes since the last ensured version of the policy.
+        # Returns the reconciled room keys (None if the whole policy was ensured) and the rooms that failed.
+        # Failed rooms keep the version unensured, so they are part of the next diff again
+        with run_context(f"ensure-changed:{policy_key}"):
+            async with self._policy_lock(policy_key):
+                versions = await self._get_policy_versions_from_db(policy_key)
+                ensured = [v['version'] for v in versions if v['ensured_at'] is not None]
+                latest = versions[-1]['version'] if versions else None
+                if not ensured:
+                    return None, await self._ensure_locked(policy_key, None, latest)
+                if ensured[-1] == latest:
+                    return set(), {}
+                diff = diff_policies(await self.get_policy_version(policy_key, ensured[-1]),
+                                     await self.get_policy_version(policy_key, latest))
+                room_keys = changed_room_keys(diff, await self.get_policy_graph(policy_key))
+                if room_keys is None:
+                    return None, await self._ensure_locked(policy_key, None, latest)
+                if not room_keys:
+                    await self._mark_policy_version_ensured(policy_key, latest)
+                    return room_keys, {}
+                return room_keys, await self._ensure_locked(policy_key, room_keys, latest)
+
+    async def retry_failed(self, policy_key):
+        # Re-runs only the rooms that failed in earlier runs, returns the retried room keys and the rooms failing again
+        failed = await self.get_failed_rooms(policy_key)
+        if not failed:
+            return set(), {}
+        graph = await self.get_policy_graph(policy_key)
+        room_keys = {room_key for room_key in failed if room_key in graph}
+        # rooms removed from the policy since can't be retried
+        for room_key in failed.keys() - room_keys:
+            await self._remove_failed_room_from_db(policy_key, room_key)
+        if not room_keys:
+            return set(), {}
+        return room_keys, await self.ensure_policy(policy_key, room_keys=room_keys)
+
+    async def get_failed_rooms(self, policy_key):
+        rows = await self._get_failed_rooms_from_db(policy_key)
+        return {row['room_key']: {'phase': row['phase'], 'error': row['error'], 'failed_at': row['failed_at']}
+                for row in rows}
+
+    async def _ensure_policy(self, policy_key, room_keys=None):
+        # room_keys limits the run to part of the policy, e.g. a subtree from get_policy_graph(...).subtree(...)
         policy = await self.get_policy(policy_key)
-        for room_key, room_policy in policy['rooms'].items():
-            invitees = {}
-            if 'invitees' in room_policy:
-                for user, pl in room_policy['invitees'].items():
-                    if user.startswith('@'):
-                        invitees[user] = max(invitees.get(user, -1), pl)
-                    else:
-                        for u in policy['user_groups'][user]['users']:
-                            invitees[u] = max(invitees.get(u, -1), pl)
-            policy['rooms'][room_key]['invitees'] = invitees
-            policy['rooms'][room_key]['room_id'] = await self._ensure_room_exists(policy['policy_key'],
-                                                                                  room_key, room_policy,
-                                                                                  existing_room_id=room_policy['room_id'] if 'room_id' in room_policy else None)
-        for room_key, room_policy in policy['rooms'].items():
-            room_id = room_policy['room_id']
-            await self._ensure_room_config(room_id, room_policy, policy['policy_key'],
-                                           default_room_settings=policy['default_room_settings'] if
-                                           'default_room_settings' in policy else None)
-            await self._ensure_room_users(room_id, room_policy)
-            await self._ensure_room_bot_actions(room_id, room_policy)
+        scope = None
+        if room_keys is not None:
+            graph = PolicyGraph(policy)
+            unknown = [k for k in room_keys if k not in graph]
+            if unknown:
+                raise ValueError(f"Rooms not in policy {policy_key}: {', '.join(unknown)}")
+            # parents have to exist to link the rooms in scope, but are not reconciled themselves
+            scope = set(room_keys)
+            required = scope.union(*[graph.ancestors(k) for k in room_keys])
+
+        # Rooms are consumed as a stream (static rooms, then generated rooms), only their room ids are kept around.
+        # Rooms are processed concurrently, each by its owning account (see AccountPool).
+        # Database writes are buffered and flushed in transactions every few rooms and at the end of each phase.
+        # A failing room is recorded with its phase and skipped in later phases, all other rooms carry on.
+        await self.accounts.refresh()
+        room_ids = {}
+        failures = {}
+        writes = WriteBuffer(self.database, checkpoint=self.db_checkpoint)
+        try:
+            with span('create rooms', cat='phase'):
+                await gather_bounded((self._isolated(failures, room_key, 'create',
+                                                     self._ensure_room_created(policy, room_key, room_policy,
+                                                                               room_ids, writes))
+                                      for room_key, room_policy in iter_policy_rooms(policy)
+                                      if scope is None or room_key in required), self.max_concurrency)
+        finally:
+            await writes.flush()
+
+        space_links = {}
+        managed_spaces = set()
+        visibilities = {}
+        with span('configure rooms', cat='phase'):
+            await gather_bounded((self._isolated(failures, room_key, 'config',
+                                                 self._ensure_room(policy, room_key, room_policy, room_ids,
+                                                                   space_links, managed_spaces, visibilities))
+                                  for room_key, room_policy in iter_policy_rooms(policy)
+                                  if (scope is None or room_key in scope) and room_key in room_ids
+                                  and room_key not in failures), self.max_concurrency)
+        room_keys_by_id = {room_id: room_key for room_key, room_id in room_ids.items()}
+        with span('room visibilities', cat='phase'):
+            await self._ensure_room_visibilities(visibilities, room_keys_by_id, failures)
+        try:
+            with span('bot actions', cat='phase'):
+                await self._ensure_bot_actions(policy, room_ids, failures, scope, writes=writes)
+        finally:
+            await writes.flush()
+        # a partial run doesn't know all children of a space, so stale links are only removed in full runs.
+        # Rooms that failed may not have reported their parents, their links are kept. That includes existing rooms
+        # that failed before their room id was known in this run (e.g. rate limited while being looked up)
+        stored = await self._get_room_ids_from_db(policy['policy_key'])
+        keep_linked = {room_ids[k] if k in room_ids else stored[k] for k in failures if k in room_ids or k in stored}
+        with span('space hierarchy', cat='phase'):
+            await self._ensure_space_hierarchy(policy['policy_key'], space_links, managed_spaces, room_keys_by_id,
+                                               failures, unlink_stale=scope is None, keep_linked=keep_linked)
+
+        # rooms dropped from the policy, full runs only: a partial run doesn't see all room keys
+        removed_rooms = policy['removed_rooms'] if 'removed_rooms' in policy else 'keep'
+        if scope is None and removed_rooms != 'keep':
+            with span('prune rooms', cat='phase'):
+                orphans = {k: v for k, v in stored.items() if k not in room_ids and k not in failures}
+                await self._prune_rooms(policy['policy_key'], orphans, removed_rooms, failures)
+
+        # helper accounts only keep their power while configuring rooms, then the primary bot takes over.
+        # Rooms a helper still owns from earlier runs (e.g. a failed hand over) are handed over again
+        with span('hand over rooms', cat='phase'):
+            await gather_bounded([self._hand_over_room(room_id, helper)
+                                  for room_id, helper in self.accounts.helper_rooms().items()], self.max_concurrency)
 
         # add implemented policy to db with extended user groups and actual room ids
-        policy['policy_key'] = '__' + policy['policy_key']
-        await self._add_policy_to_db(policy)
+        # (generated rooms are not materialized, their room ids are kept in the rooms table)
+        with span('save policy', cat='phase'):
+            if scope is not None or failures:
+                policy = await self._merge_processed_rooms(policy, scope, failures.keys())
+            self._record_failed_rooms(writes, policy['policy_key'], scope, failures)
+            policy['policy_key'] = '__' + policy['policy_key']
+            await self._add_policy_to_db(policy, writes=writes)
+            await writes.flush()
+        return failures
+
+    async def get_removed_rooms(self, policy_key):
+        # Rooms in the db whose keys are no longer part of the policy: one query for the stored rooms,
+        # the set difference is taken against the policy's (static and generated) room keys
+        policy = await self.get_policy(policy_key)
+        stored = await self.get_room_ids(policy_key)
+        room_keys = {room_key for room_key, _ in iter_policy_rooms(policy)}
+        return policy, {room_key: room_id for room_key, room_id in stored.items() if room_key not in room_keys}
+
+    async def prune_removed_rooms(self, policy_key, mode=None):
+        # mode defaults to the policy's removed_rooms setting, returns (mode, pruned rooms, failures)
+        with run_context(f"prune:{policy_key}"):
+            async with self._policy_lock(policy_key):
+                policy, orphans = await self.get_removed_rooms(policy_key)
+                mode = mode or (policy['removed_rooms'] if 'removed_rooms' in policy else 'keep')
+                failures = {}
+                if mode != 'keep':
+                    await self._prune_rooms(policy_key, orphans, mode, failures)
+                return mode, orphans, failures
+
+    async def _prune_rooms(self, policy_key, orphans, mode, failures):
+        if mode not in ['unlink', 'archive', 'delete']:
+            raise ValueError(f"Not a valid mode for removed rooms: {mode}, use one of keep, unlink, archive, delete")
+        self.logger.info("Pruning %s rooms removed from %s (%s)", len(orphans), policy_key, mode)
+        await gather_bounded([self._isolated(failures, room_key, 'prune',
+                                             self._prune_room(policy_key, room_key, room_id, mode))
+                              for room_key, room_id in orphans.items()], self.max_concurrency)
+
+    async def _prune_room(self, policy_key, room_key, room_id, mode):
+        # unlink: only remove the room from its spaces, archive: also close it for joining and unpublish it,
+        # delete: delete the room. In every case the room is no longer managed by the policy afterwards
+        if mode == 'delete':
+            await delete_room(self.client, room_id, admin_api=self.admin_api)
+        else:
+            await self._unlink_room(room_id)
+            if mode == 'archive':
+                await self._set_room_join_rules(room_id, 'invite')
+                await self._set_room_visibility(room_id, 'private')
+        await self._forget_room(policy_key, room_key, room_id)
+
+    async def _unlink_room(self, room_id):
+        client = self.accounts.client_for(room_id)
+        state = await client.api.request(Method.GET, f"/_matrix/client/v3/rooms/{room_id}/state")
+        for space_id in [e['state_key'] for e in state if e['type'] == 'm.space.parent' and e.get('content')]:
+            self.logger.debug("Unlinking %s from %s", room_id, space_id)
+            try:
+                await self.accounts.client_for(space_id).send_state_event(space_id, 'm.space.child', {},
+                                                                          state_key=room_id)
+            except MForbidden as err:
+                self.logger.warning("Failed to remove %s from space %s: %s", room_id, space_id, err)
+            await client.send_state_event(room_id, 'm.space.parent', {}, state_key=space_id)
+
+    async def _hand_over_room(self, room_id, helper):
+        try:
+            await hand_over_room(helper, self.client, room_id)
+            self.accounts.release(room_id, helper)
+        except Exception as err:
+            self.logger.warning("Failed to hand over %s from %s, retrying in the next run: %s", room_id, helper.mxid,
+                                err)
+
+    async def _isolated(self, failures, room_key, phase, coro):
+        try:
+            return await coro
+        except Exception as err:
+            self.logger.error("Room %s failed (%s): %s", room_key, phase, err)
+            failures[room_key] = (phase, err)
+
+    async def _ensure_room_created(self, policy, room_key, room_policy, room_ids, writes):
+        invitee_groups = {}
+        room_policy['invitees'] = self._expand_invitees(policy, room_policy, invitee_groups)
+        room_ids[room_key] = await self._ensure_room_exists(policy['policy_key'],
+                                                            room_key, room_policy,
+                                                            existing_room_id=room_policy['room_id'] if 'room_id' in room_policy else None,
+                                                            writes=writes)
+        self._index_room_users(writes, policy['policy_key'], room_key, room_ids[room_key],
+                               room_policy['invitees'], invitee_groups)
+        await writes.room_done()
+
+    async def _ensure_room(self, policy, room_key, room_policy, room_ids, space_links, managed_spaces, visibilities):
+        room_id = room_ids[room_key]
+        room_policy['invitees'] = self._expand_invitees(policy, room_policy)
+        room_policy['room_id'] = room_id
+        if 'is_space' in room_policy and room_policy['is_space']:
+            managed_spaces.add(room_id)
+        await self._ensure_room_config(room_id, room_policy, policy['policy_key'], space_links,
+                                       default_room_settings=policy['default_room_settings'] if
+                                       'default_room_settings' in policy else None, room_ids=room_ids,
+                                       visibilities=visibilities)
+        await self._ensure_room_users(room_id, room_policy)
+
+    async def _merge_processed_rooms(self, policy, scope, failed):
+        # Partial runs only update their rooms in the previously processed policy, failed rooms keep their old version
+        try:
+            processed = await self.get_policy(policy['policy_key'], export_mode=True)
+        except PolicyNotFoundError:
+            return policy
+        processed_rooms = processed['rooms'] if 'rooms' in processed else {}
+        policy['rooms'] = {room_key: processed_rooms[room_key] if room_key in processed_rooms and (
+                               room_key in failed or scope is not None and room_key not in scope) else room_policy
+                           for room_key, room_policy in policy.get('rooms', {}).items()}
+        return policy
+
+    async def get_policy_graph(self, policy_key):
+        return PolicyGraph(await self.get_policy(policy_key))
+
+    @staticmethod
+    def _expand_invitees(policy, room_policy, invitee_groups=None):
+        # invitee_groups (optional) receives the user group each user's power level comes from (None if listed directly)
+        invitees = {}
+        invitee_groups = {} if invitee_groups is None else invitee_groups
+        if 'invitees' in room_policy:
+            for user, pl in room_policy['invitees'].items():
+                if user.startswith('@'):
+                    if pl > invitees.get(user, -1):
+                        invitees[user] = pl
+                        invitee_groups[user] = None
+                else:
+                    for u in policy['user_groups'][user]['users']:
+                        if pl > invitees.get(u, -1):
+                            invitees[u] = pl
+                            invitee_groups[u] = user
+        return invitees
 
     async def ensure_policy_destroyed(self, policy_name):
         # Get all rooms related to this policy
         q = "SELECT matrix_room_id FROM rooms WHERE policy_key = $1"
         rooms = await self.database.fetch(q, policy_name)
         for room in rooms:
-            await delete_room(self.client, room['matrix_room_id'])
+            await delete_room(self.client, room['matrix_room_id'], admin_api=self.admin_api)
         await self.forget_policy(policy_name)
 
     async def forget_policy(self, policy_name):
-        self.logger.info(f"Removing policy {policy_name} from db")
+        self.logger.info("Removing policy %s from db", policy_name)
         q = "DELETE FROM rooms WHERE policy_key = $1"
         await self.database.execute(q, policy_name)
+        q = "DELETE FROM user_rooms WHERE policy_key = $1"
+        await self.database.execute(q, policy_name)
+        q = "DELETE FROM bot_action_ledger WHERE policy_key = $1"
+        await self.database.execute(q, policy_name)
+        q = "DELETE FROM failed_rooms WHERE policy_key = $1"
+        await self.database.execute(q, policy_name)
+        self.room_index = None
         # q = "DELETE FROM policies WHERE policy_key = $1"
         # await self.database.execute(q, policy_key)
 
-    async def add_policy(self, policy_as_json) -> str:
+    async def add_policy(self, policy_as_json, writes=None) -> str:
         # TODO validate against schema
         # TODO Add empty dicts for default_room_settings and user_groups if they don't exist
         # TODO validate room_ids if passed
         # TODO validate that policy key doesn't start with '__'
-        await self._add_policy_to_db(policy_as_json)
+        # The policy, its new version and its user index are written in one transaction (the caller's, if writes
+        # is passed), a failure leaves none of them behind
+        own_writes = writes is None
+        writes = WriteBuffer(self.database) if own_writes else writes
+        await self._add_policy_to_db(policy_as_json, writes=writes)
+        self._add_policy_version_to_db(writes, policy_as_json)
+        await self._reindex_policy_users(writes, policy_as_json)
+        if own_writes:
+            await writes.flush()
+        self.room_index = None
         return policy_as_json['policy_key']
 
+    async def _reindex_policy_users(self, writes, policy):
+        # Users added to (or removed from) a policy or its user groups are found by ensure-user and offboard-user
+        # right away, not only after the next ensure-policy. Rooms that weren't created yet are indexed on creation.
+        # The policy itself may not be stored yet, its rooms are read without checking for it
+        room_ids = await self._get_room_ids_from_db(policy['policy_key'])
+        writes.add("DELETE FROM user_rooms WHERE policy_key=$1", policy['policy_key'])
+        for room_key, room_policy in iter_policy_rooms(policy):
+            if room_key in room_ids:
+                invitee_groups = {}
+                invitees = self._expand_invitees(policy, room_policy, invitee_groups)
+                self._index_room_users(writes, policy['policy_key'], room_key, room_ids[room_key], invitees,
+                                       invitee_groups)
+
     async def get_policy(self, policy_key: str, export_mode=False) -> json:
         if export_mode:
             policy_key = '__' + policy_key
@@ -104,15 +438,78 @@ class MatrixSecretary:
         except DatabaseEntryNotFoundException:
             raise PolicyNotFoundError(f"Policy {policy_key} not found.")
 
+    async def get_policy_versions(self, policy_key):
+        rows = await self._get_policy_versions_from_db(policy_key)
+        if not rows:
+            raise PolicyNotFoundError(f"Policy {policy_key} not found.")
+        return [dict(row) for row in rows]
+
+    async def get_policy_version_tag(self, policy_key):
+        # Changes whenever a new version of the policy is uploaded, None for policies without history
+        q = "SELECT version, policy_hash FROM policy_versions WHERE policy_key=$1 ORDER BY version DESC LIMIT 1"
+        latest = await self.database.fetchrow(q, policy_key)
+        return f"{latest['version']}:{latest['policy_hash']}" if latest else None
+
+    async def get_policy_version_tags(self):
+        # {policy key: version tag} of all available policies in one query, see get_policy_version_tag
+        q = """SELECT p.policy_key, v.version, v.policy_hash FROM policies p
+               LEFT JOIN (SELECT policy_key, MAX(version) AS version FROM policy_versions GROUP BY policy_key) m
+                 ON m.policy_key = p.policy_key
+               LEFT JOIN policy_versions v ON v.policy_key = m.policy_key AND v.version = m.version
+               ORDER BY p.policy_key"""
+        return {row['policy_key']: f"{row['version']}:{row['policy_hash']}" if row['version'] is not None else None
+                for row in await self.database.fetch(q) if not row['policy_key'].startswith('__')}
+
+    async def get_room_policy(self, policy_key, room_key):
+        for key, room_policy in iter_policy_rooms(await self.get_policy(policy_key)):
+            if key == room_key:
+                return room_policy
+        raise PolicyNotFoundError(f"Room {room_key} not found in policy {policy_key}.")
+
+    async def get_policy_version(self, policy_key, version):
+        try:
+            return await self._get_policy_version_from_db(policy_key, version)
+        except DatabaseEntryNotFoundException:
+            raise PolicyNotFoundError(f"Version {version} of policy {policy_key} not found.")
+
+    async def diff_policy_versions(self, policy_key, old_version=None, new_version=None):
+        # Defaults to the latest version and the one before it, returns (old_version, new_version, diff)
+        versions = [v['version'] for v in await self.get_policy_versions(policy_key)]
+        new_version = versions[-1] if new_version is None else new_version
+        if old_version is None:
+            older = [v for v in versions if v < new_version]
+            if not older:
+                raise ValueError(f"Policy {policy_key} has no version before version {new_version}")
+            old_version = older[-1]
+        diff = diff_policies(await self.get_policy_version(policy_key, old_version),
+                             await self.get_policy_version(policy_key, new_version))
+        return old_version, new_version, diff
+
+    async def get_room_ids(self, policy_key):
+        room_ids = await self._get_room_ids_from_db(policy_key)
+        if not room_ids and policy_key not in await self.get_available_policies():
+            raise PolicyNotFoundError(f"Policy {policy_key} not found.")
+        return room_ids
+
     async def get_available_policies(self):
         q = "SELECT policy_key FROM policies"
         result = await self.database.fetch(q)
         return [row[0] for row in result if not row[0].startswith('__')]
 
-    async def load_example_policies(self):
-        policies = get_example_policies()
-        for policy in policies:
-            await self.add_policy(policy)
+    async def load_example_policies(self, policy_keys=None):
+        # Build one example policy at a time, only the ones that were asked for
+        policy_keys = get_example_policy_keys() if not policy_keys else policy_keys
+        writes = WriteBuffer(self.database)
+        for policy_key in policy_keys:
+            await self.add_policy(get_example_policy(policy_key), writes=writes)
+        await writes.flush()
+        return policy_keys
+
+    async def add_synthetic_policy(self, **params):
+        # see example_policies/synthetic.py for the parameters
+        policy = get_synthetic_policy(**params)
+        await self.add_policy(policy)
+        return policy
 
     ####################################################################################################################
     # Room management                                                                                                  #
@@ -125,16 +522,21 @@ class MatrixSecretary:
 
         # mostly for testing, destroy everything the bot is in
         joined_rooms = await self.client.get_joined_rooms()
-        self.logger.info(f"I'm currently in these rooms:\n  " + '\n  '.join(joined_rooms))
+        self.logger.info("I'm currently in these rooms:\n  %s", '\n  '.join(joined_rooms))
+        # one bulk lookup of member counts saves fetching the members of rooms where I'm alone
+        room_details = await self._get_admin_room_details()
         failed = []
         for room in joined_rooms:
-            members = [m for m in await self.client.get_joined_members(room) if
-                       not ignore_bots or not m.startswith('@bot.') or m == self.mxid]
+            if room in room_details and room_details[room]['joined_members'] == 1:
+                members = [self.mxid]
+            else:
+                members = [m for m in await self.client.get_joined_members(room) if
+                           not ignore_bots or not m.startswith('@bot.') or m == self.mxid]
             alone = len(members) == 1 and members[0] == self.mxid and await room_not_in_db(room)
             if room != self.notice_room and (not only_abandoned or alone):
-                self.logger.info(f"Deleting room {room}")
+                self.logger.info("Deleting room %s", room)
                 try:
-                    await delete_room(self.client, room)
+                    await delete_room(self.client, room, admin_api=self.admin_api)
                 except Exception as err:
                     failed.append((room, err))
         failed_str = ' \n... except for:\n  ' + '\n  '.join([f"{r}: {e}" for r, e in failed])
@@ -142,7 +544,28 @@ class MatrixSecretary:
         self.logger.info(msg)
         return msg
 
-    async def _ensure_room_exists(self, policy_key, room_key, room_policy, existing_room_id=None):
+    async def _get_admin_room_details(self):
+        if self.admin_api is None or not self.admin_api.available:
+            return {}
+        try:
+            return await self.admin_api.list_rooms()
+        except AdminAPIUnavailableError:
+            return {}
+
+    async def _ensure_joined(self, room_id):
+        # Join a room to adopt it, force-join through the admin API if the room can't be joined otherwise
+        try:
+            await self.client.join_room(room_id)
+        except MForbidden:
+            if self.admin_api is None or not self.admin_api.available:
+                raise
+            try:
+                await self.admin_api.join_user(room_id, self.mxid)
+            except AdminAPIUnavailableError:
+                raise MForbidden(403, f"Can't join {room_id} and the admin API is not available")
+
+    @traced(args=('room_key',))
+    async def _ensure_room_exists(self, policy_key, room_key, room_policy, existing_room_id=None, writes=None):
         try:
             # Is room already in db?
             room_id = await self._get_room_from_db(policy_key, room_key)
@@ -151,24 +574,39 @@ class MatrixSecretary:
         except DatabaseEntryNotFoundException:
             # Room not in db, create it or add it if existing_room_id is passed
             if existing_room_id is None:
-                self.logger.info(f"Room {policy_key}:{room_key} not found in db, creating it")
-                room_id = await self._create_room(room_policy)
+                self.logger.info("Room %s:%s not found in db, creating it", policy_key, room_key)
+                room_id = await self._create_room(room_policy, self.accounts.owner(room_key))
             else:
                 room_id = existing_room_id
-            await self._add_room_to_db(policy_key, room_key, room_id)
+                await self._ensure_joined(room_id)
+                self.accounts.owner(room_key, room_id)
+            await self._add_room_to_db(policy_key, room_key, room_id, writes=writes)
+            return room_id
+        self.accounts.owner(room_key, room_id)
         return room_id
 
-    async def _create_room(self, room_policy):
+    @traced()
+    async def _create_room(self, room_policy, account):
+        # Helper accounts create the room with the primary bot as admin, who then joins and keeps full power.
+        # The helper configures the room and hands it over at the end of the run, see hand_over_room
         room_id = await create_room(
-            self.client,
+            account,
             room_policy['room_name'] if 'room_name' in room_policy else 'Pretty Placeholder',
             room_policy['invitees'] if 'invitees' in room_policy else {},
             is_space=room_policy['is_space'] if 'is_space' in room_policy else False,
             topic=room_policy['topic'] if 'topic' in room_policy else '',
+            admin=self.mxid if account is not self.client else None,
         )
+        self.accounts.assign(room_id, account)
+        if account is not self.client:
+            await self.client.join_room(room_id)
         return room_id
 
-    async def _ensure_room_config(self, room_id, room_policy, policy_key, default_room_settings=None):
+    @traced(args=('room_id',))
+    async def _ensure_room_config(self, room_id, room_policy, policy_key, space_links, default_room_settings=None,
+                                  room_ids=None, visibilities=None):
+        # parent/child edges are only collected in space_links here, see _ensure_space_hierarchy.
+        # If visibilities is passed, directory visibility is collected there too, see _ensure_room_visibilities
         default_room_settings = {} if default_room_settings is None else default_room_settings
         parent_spaces = []
         parent_spaces_secret = []
@@ -178,29 +616,18 @@ class MatrixSecretary:
             await self._set_room_state(room_id, 'name', room_policy['room_name'])
         if 'room_alias' in room_policy:
             await self._set_room_alias(room_id, room_policy['room_alias'])
+        suggested = room_policy['suggested'] if 'suggested' in room_policy else False
         if 'parent_spaces' in room_policy:
-            for p in room_policy['parent_spaces']:
-                if is_matrix_room_id(p):
-                    parent_spaces.append(p)
-                elif is_matrix_room_alias(p):
-                    parent_spaces.append(self.client.api.request(Method.GET, f"/_matrix/client/r0/directory/room/{p}"))
-                else:
-                    parent_spaces.append(await self._get_room_from_db(policy_key, p))
+            parent_spaces = await self._resolve_parent_spaces(policy_key, room_policy['parent_spaces'], room_ids)
             room_policy['parent_spaces'] = parent_spaces
-            await self._ensure_parent_spaces(room_id, parent_spaces,
-                                             room_policy['suggested'] if 'suggested' in room_policy else False)
+            for ps in parent_spaces:
+                space_links.setdefault(ps, {})[room_id] = suggested
         if 'parent_spaces_silent' in room_policy:
-            for p in room_policy['parent_spaces_silent']:
-                if is_matrix_room_id(p):
-                    parent_spaces_secret.append(p)
-                elif is_matrix_room_alias(p):
-                    parent_spaces_secret.append(
-                        self.client.api.request(Method.GET, f"/_matrix/client/r0/directory/room/{p}"))
-                else:
-                    parent_spaces_secret.append(await self._get_room_from_db(policy_key, p))
+            parent_spaces_secret = await self._resolve_parent_spaces(policy_key, room_policy['parent_spaces_silent'],
+                                                                     room_ids)
             room_policy['parent_spaces_silent'] = parent_spaces_secret
-            await self._ensure_parent_spaces(room_id, parent_spaces_secret,
-                                             room_policy['suggested'] if 'suggested' in room_policy else False)
+            for ps in parent_spaces_secret:
+                space_links.setdefault(ps, {})[room_id] = suggested
 
         if 'room_avatar' in room_policy:
             await self._set_room_avatar(room_id, room_policy['room_avatar'])
@@ -214,78 +641,184 @@ class MatrixSecretary:
             join_rules = room_policy['join_rule'] if 'join_rule' in room_policy else default_room_settings['join_rule']
         else:
             join_rules = 'restricted'
-        await self._set_room_join_rules(room_id, join_rules, parent_spaces)
+        allow_spaces = parent_spaces
+        if 'allow_spaces' in room_policy:
+            allow_spaces = parent_spaces + await self._resolve_parent_spaces(policy_key, room_policy['allow_spaces'],
+                                                                             room_ids)
+        await self._set_room_join_rules(room_id, join_rules, allow_spaces)
         if 'visibility' in room_policy or 'visibility' in default_room_settings:
             visibility = room_policy['visibility'] if 'visibility' in room_policy else default_room_settings[
                 'visibility']
-            await self._set_room_visibility(room_id, visibility)
+            if visibilities is None:
+                await self._set_room_visibility(room_id, visibility)
+            else:
+                is_legal('visibility', visibility)
+                visibilities[room_id] = visibility
         for key in ['history_visibility', 'guest_access', ]:
             if key in room_policy or key in default_room_settings:
                 value = room_policy[key] if key in room_policy else default_room_settings[key]
                 await self._set_room_state(room_id, key, value)
 
-    async def _ensure_parent_spaces(self, room_id, parent_spaces, suggested=False):
-        parent_event_content = json.dumps(
-            {'auto_join': False, 'suggested': suggested, 'via': [self.client.mxid.split(':')[1]]})
-        child_event_content = json.dumps(
-            {'canonical': True, 'via': [self.client.mxid.split(':')[1]]})
+    async def _resolve_parent_spaces(self, policy_key, parent_spaces, room_ids=None):
+        # room_ids (room key -> room id) of the current run saves looking up parents in the db
+        room_ids = {} if room_ids is None else room_ids
+        resolved = []
+        for p in parent_spaces:
+            if p in room_ids:
+                resolved.append(room_ids[p])
+            elif is_matrix_room_id(p):
+                resolved.append(p)
+            elif is_matrix_room_alias(p):
+                resolved.append((await self.client.resolve_room_alias(p)).room_id)
+            else:
+                resolved.append(await self._get_room_from_db(policy_key, p))
+        return resolved
+
+    async def _ensure_space_hierarchy(self, policy_key, space_links, managed_spaces, room_keys, failures,
+                                      unlink_stale=True, keep_linked=()):
+        # Fetch each managed space's children once and only send events for missing, changed or stale edges.
+        # Failures are recorded per space (by room key, or room id for spaces outside the policy)
+        server = self.client.mxid.split(':')[1]
+        managed_room_ids = set((await self.get_room_ids(policy_key)).values()) - set(keep_linked)
+        for space_id in managed_spaces | space_links.keys():
+            await self._isolated(failures, room_keys.get(space_id, space_id), 'space_hierarchy',
+                                 self._ensure_space_children(space_id, space_links.get(space_id, {}), server,
+                                                             managed_room_ids if unlink_stale else set()))
 
-        for ps in parent_spaces:
-            self.logger.debug(f"Setting {ps} as parent of {room_id}")
-            await self.client.send_state_event(ps, 'm.space.child', parent_event_content, state_key=room_id)
-            await self.client.send_state_event(room_id, 'm.space.parent', child_event_content, state_key=ps)
+    @traced(args=('space_id',))
+    async def _ensure_space_children(self, space_id, desired_children, server, managed_room_ids):
+        current_children = await get_space_children(self.accounts.client_for(space_id), space_id)
+        to_link, to_unlink = diff_space_children(current_children, desired_children, server, managed_room_ids)
+        self.logger.debug("Space %s: linking %s, unlinking %s children", space_id, len(to_link), len(to_unlink))
+        for child_id, suggested in to_link.items():
+            self.logger.debug("Setting %s as parent of %s", space_id, child_id)
+            await self.accounts.client_for(space_id).send_state_event(
+                space_id, 'm.space.child', child_event_content(server, suggested), state_key=child_id)
+            await self.accounts.client_for(child_id).send_state_event(
+                child_id, 'm.space.parent', parent_event_content(server), state_key=space_id)
+        for child_id in to_unlink:
+            self.logger.debug("Removing stale child %s from %s", child_id, space_id)
+            await self.accounts.client_for(space_id).send_state_event(space_id, 'm.space.child', {},
+                                                                      state_key=child_id)
+            try:
+                await self.accounts.client_for(child_id).send_state_event(child_id, 'm.space.parent', {},
+                                                                          state_key=space_id)
+            except MForbidden as err:
+                self.logger.exception("Failed to remove parent %s from %s: %s", space_id, child_id, err)
 
     async def _set_room_join_rules(self, room_id, join_rule, parent_spaces=None):
+        client = self.accounts.client_for(room_id)
         is_legal('join_rule', join_rule)
         join_rules_content = {'join_rule': join_rule}
-        self.logger.debug(f"Setting join rule of {room_id} to {join_rule}")
+        self.logger.debug("Setting join rule of %s to %s", room_id, join_rule)
         if parent_spaces:
-            self.logger.debug(f"Adding parent spaces {parent_spaces} to join rule of {room_id}")
+            self.logger.debug("Adding parent spaces %s to join rule of %s", parent_spaces, room_id)
             join_rules_content['allow'] = [{'type': 'm.room_membership', 'room_id': ps} for ps in parent_spaces]
         join_rules_content = json.dumps(join_rules_content)
-        await self.client.send_state_event(room_id, 'm.room.join_rules', join_rules_content, state_key="")
+        await client.send_state_event(room_id, 'm.room.join_rules', join_rules_content, state_key="")
+
+    async def _ensure_room_visibilities(self, visibilities, room_keys, failures):
+        # Directory publication isn't room state: fetch what's published once per run, then only fix wrong rooms
+        published, exact = await self._get_published_rooms()
+        updates = []
+        for room_id, visibility in visibilities.items():
+            if published is None:
+                updates.append((room_id, visibility, True))
+            elif visibility == 'private' and room_id in published:
+                updates.append((room_id, visibility, False))
+            elif visibility == 'public' and room_id not in published:
+                # the client API's directory hides published rooms that aren't joinable or world-readable,
+                # so without the admin API these rooms are checked before publishing them
+                updates.append((room_id, visibility, not exact))
+        self.logger.debug("%s of %s rooms may have the wrong directory visibility", len(updates), len(visibilities))
+        await gather_bounded([self._isolated(failures, room_keys[room_id], 'visibility',
+                                             self._set_room_visibility(room_id, visibility, check=check))
+                              for room_id, visibility, check in updates], self.max_concurrency)
+
+    async def _get_published_rooms(self):
+        # Returns the ids of rooms published in our server's directory and whether that list is complete
+        room_details = await self._get_admin_room_details()
+        if room_details:
+            return {room_id for room_id, room in room_details.items() if room.get('public')}, True
+        published = set()
+        params = {'limit': '500'}
+        try:
+            while True:
+                result = await self.client.api.request(Method.GET, "/_matrix/client/v3/publicRooms",
+                                                       query_params=params)
+                published.update(room['room_id'] for room in result.get('chunk', []))
+                if not result.get('next_batch'):
+                    return published, False
+                params['since'] = result['next_batch']
+        except MatrixRequestError as err:
+            self.logger.warning("Could not fetch the public room directory, checking rooms one by one: %s", err)
+            return None, False
 
-    async def _set_room_visibility(self, room_id, visibility):
+    async def _set_room_visibility(self, room_id, visibility, check=True):
+        client = self.accounts.client_for(room_id)
         # Controls whether a room is published to public room directory.
         is_legal('visibility', visibility)
         api_link = f"/_matrix/client/r0/directory/list/room/{room_id}"
-        current_value = await self.client.api.request(Method.GET, api_link)
+        current_value = await client.api.request(Method.GET, api_link) if check else {'visibility': None}
         if current_value['visibility'] != visibility:
-            self.logger.debug(f"Setting room visibility of {room_id} to {visibility}")
-            await self.client.api.request(Method.PUT, api_link, {'visibility': visibility})
+            self.logger.debug("Setting room visibility of %s to %s", room_id, visibility)
+            await client.api.request(Method.PUT, api_link, {'visibility': visibility})
         else:
-            self.logger.debug(f"Room visibility of {room_id} already set to {visibility}")
+            self.logger.debug("Room visibility of %s already set to %s", room_id, visibility)
 
     async def _set_room_state(self, room_id, key, value):
+        client = self.accounts.client_for(room_id)
         is_legal(key, value)
         api_link = f"/_matrix/client/r0/rooms/{room_id}/state/m.room.{key}"
         try:
-            current_value = await self.client.api.request(Method.GET, api_link)
+            current_value = await client.api.request(Method.GET, api_link)
         except MNotFound:
             current_value = {key: None}
         if current_value[key] != value:
-            self.logger.debug(f"Setting room {key} of {room_id} to {value}")
-            await self.client.api.request(Method.PUT, api_link, content={key: value})
+            self.logger.debug("Setting room %s of %s to %s", key, room_id, value)
+            await client.api.request(Method.PUT, api_link, content={key: value})
         else:
-            self.logger.debug(f"Room {key} of {room_id} is already {value}")
+            self.logger.debug("Room %s of %s is already %s", key, room_id, value)
 
-    async def _set_room_avatar(self, room_id, avatar_url):
+    async def _set_room_avatar(self, room_id, avatar):
+        # avatar is an mxc URI, an http(s) URL or a local file, the latter are uploaded once and cached by content
+        avatar_url = await self._resolve_avatar(avatar)
+        client = self.accounts.client_for(room_id)
         try:
             try:
-                room_info = await self.client.api.request(Method.GET,
+                room_info = await client.api.request(Method.GET,
                                                           f"/_matrix/client/r0/rooms/{room_id}/state/m.room.avatar")
             except MNotFound:
                 room_info = {}
             current_value = room_info['url'] if 'url' in room_info else None
-            self.logger.debug(f"Room {room_id} has avatar {current_value}")
+            self.logger.debug("Room %s has avatar %s", room_id, current_value)
             if current_value != avatar_url:
-                self.logger.debug(f"Setting avatar for room {room_id} to {avatar_url}")
-                await self.client.send_state_event(room_id, 'm.room.avatar',
+                self.logger.debug("Setting avatar for room %s to %s", room_id, avatar_url)
+                await client.send_state_event(room_id, 'm.room.avatar',
                                                    RoomAvatarStateEventContent(url=avatar_url))
             else:
-                self.logger.debug(f"Room {room_id} already has avatar {avatar_url}")
+                self.logger.debug("Room %s already has avatar %s", room_id, avatar_url)
         except MForbidden as err:
-            self.logger.exception(f"Failed to set room avatar for room {room_id}: {err}")
+            self.logger.exception("Failed to set room avatar for room %s: %s", room_id, err)
+
+    async def _resolve_avatar(self, avatar):
+        if is_mxc(avatar):
+            return avatar
+        # rooms sharing an avatar wait for the same task, a failed load fails all of them in this run
+        if avatar not in self.avatar_uploads:
+            self.avatar_uploads[avatar] = asyncio.ensure_future(self._upload_avatar(avatar))
+        return await asyncio.shield(self.avatar_uploads[avatar])
+
+    async def _upload_avatar(self, avatar):
+        data, mime_type, file_name = await load_image(avatar, self.client.api.session, self.avatar_dir)
+        avatar_hash = content_hash(data)
+        avatar_url = await self._get_avatar_from_db(avatar_hash)
+        if avatar_url is None:
+            avatar_url = str(await self.client.upload_media(data, mime_type=mime_type, filename=file_name,
+                                                            size=len(data)))
+            self.logger.info("Uploaded avatar %s as %s", avatar, avatar_url)
+            await self._add_avatar_to_db(avatar_hash, avatar_url)
+        return avatar_url
 
     async def _set_room_encryption(self, room_id, encrypt):
         raise NotImplementedError("Encryption is not yet implemented")
@@ -295,30 +828,33 @@ class MatrixSecretary:
             await self.client.send_state_event(room_id, 'm.room.encryption', encryption_content, state_key="")
             self.logger.debug('encrypting room...')
         elif not encrypt and 'encryption' in room_encryption:
-            self.logger.warn('disabling encryption is not supported')
+            self.logger.warning('disabling encryption is not supported')
         else:
             self.logger.debug('room is already encrypted')
 
     async def _set_room_alias(self, room_id, value, override=False):
+        client = self.accounts.client_for(room_id)
         alias = escape_as_alias(value)
         try:
-            room_aliases = await self.client.api.request(Method.GET, f"/_matrix/client/r0/rooms/{room_id}/aliases")
-            self.logger.debug(f"Room {room_id} has aliases {room_aliases}")
-            if f"#{alias}:{self.client.mxid.split(':')[1]}" not in room_aliases['aliases']:
-                self.logger.debug(f"Setting alias for room {room_id} to {alias}")
-                await self.client.add_room_alias(room_id, alias, override=override)
+            room_aliases = await client.api.request(Method.GET, f"/_matrix/client/r0/rooms/{room_id}/aliases")
+            self.logger.debug("Room %s has aliases %s", room_id, room_aliases)
+            if f"#{alias}:{self.mxid.split(':')[1]}" not in room_aliases['aliases']:
+                self.logger.debug("Setting alias for room %s to %s", room_id, alias)
+                await client.add_room_alias(room_id, alias, override=override)
             else:
-                self.logger.debug(f"Room {room_id} already has alias {alias}")
+                self.logger.debug("Room %s already has alias %s", room_id, alias)
         except MForbidden as err:
-            self.logger.exception(f"Failed to set alias for room {room_id}: {err}")
+            self.logger.exception("Failed to set alias for room %s: %s", room_id, err)
 
+    @traced(args=('room_id',))
     async def _ensure_room_users(self, room_id, room_policy):
-        self.logger.debug(f"Ensuring users in room {room_id}: {room_policy['invitees']}")
+        client = self.accounts.client_for(room_id)
+        self.logger.debug("Ensuring users in room %s: %s", room_id, room_policy['invitees'])
         # Get room member list
-        room_members = await self.client.get_joined_members(room_id)
-        self.logger.debug(f"Room {room_id} has {len(room_members)} members")
+        room_members = await client.get_joined_members(room_id)
+        self.logger.debug("Room %s has %s members", room_id, len(room_members))
 
-        power_levels = await self.client.get_state_event(room_id, EventType.ROOM_POWER_LEVELS, "")
+        power_levels = await client.get_state_event(room_id, EventType.ROOM_POWER_LEVELS, "")
 
         for user, pl in room_policy['invitees'].items():
             # Check if user is in room_members-list, otherwise retrieve membership via api call
@@ -329,38 +865,271 @@ class MatrixSecretary:
 
             # Ensure membership and powerlevels
             if not membership:
-                self.logger.debug(f"Inviting user {user} to {room_id} (membership before: {membership})")
-                await self.client.invite_user(room_id, user)
+                self.logger.debug("Inviting user %s to %s (membership before: %s)", user, room_id, membership)
+                await client.invite_user(room_id, user)
                 power_levels.set_user_level(user, pl)
             else:
-                self.logger.debug(f"User {user} was already invited to {room_id} (current membership: {membership})")
+                self.logger.debug("User %s was already invited to %s (current membership: %s)", user, room_id, membership)
                 if power_levels.get_user_level(user) < pl:
                     power_levels.ensure_user_level(user, pl)
 
-        await self.client.send_state_event(room_id, EventType.ROOM_POWER_LEVELS, power_levels)
+        await client.send_state_event(room_id, EventType.ROOM_POWER_LEVELS, power_levels)
 
-    async def _ensure_room_bot_actions(self, room_id, room_policy):
-        # if 'actions' in room_data:
-        #     # Check if actions need to be run?!
-        #     for room_action in room_data['actions']:
-        #         for bot_id in policy['actions'][room_action['template']]['bots']:
-        #             self.logger.debug(f"Inviting bot {bot_id} to {room_id}")
-        #             await self.client.invite_user(room_id, bot_id)
-        #         for cmd in policy['actions'][room_action['template']]['commands']:
-        #             cmd = cmd.format(**room_action['format']) if 'format' in room_action else cmd
-        #             self.logger.debug(f"Sending command {cmd} to {room_id}")
-        #             await self.client.send_markdown(room_id, cmd, msgtype=MessageType.TEXT, allow_html=True)
+    async def _ensure_bot_actions(self, policy, room_ids, failures, scope=None, writes=None):
+        # Bot actions of all rooms run concurrently; the ledger keeps commands from being sent again on later runs
+        policy_bot_actions = policy['bot_actions'] if 'bot_actions' in policy else {}
+        ledger = await self._get_bot_action_ledger_from_db(policy['policy_key'])
+        rooms = ((room_key, room_policy) for room_key, room_policy in iter_policy_rooms(policy)
+                 if (scope is None or room_key in scope) and room_key in room_ids and room_key not in failures
+                 and any(room_actions(room_policy)))
+        await gather_bounded((self._isolated(failures, room_key, 'bot_actions',
+                                             self._ensure_room_bot_actions(policy['policy_key'], room_ids[room_key],
+                                                                           room_policy, policy_bot_actions, ledger,
+                                                                           writes=writes))
+                              for room_key, room_policy in rooms), self.max_concurrency)
 
-        pass
+    @traced(args=('room_id',))
+    async def _ensure_room_bot_actions(self, policy_key, room_id, room_policy, policy_bot_actions, ledger,
+                                       writes=None):
+        client = self.accounts.client_for(room_id)
+        commands = [(bots, cmd) for bots, cmd in expand_bot_actions(policy_bot_actions, room_policy)
+                    if (room_id, ' '.join(bots), cmd) not in ledger]
+        if not commands:
+            return
+        room_members = await client.get_joined_members(room_id)
+        waiting = set()
+        for bot_id in {bot_id for bots, _ in commands for bot_id in bots}:
+            if bot_id not in room_members:
+                waiting.add(bot_id)
+                if not await self._get_user_membership(room_id, bot_id):
+                    self.logger.debug("Inviting bot %s to %s", bot_id, room_id)
+                    await client.invite_user(room_id, bot_id)
+        # invited bots usually join right away, they get bot_join_timeout seconds
+        deadline = time.monotonic() + self.bot_join_timeout
+        while waiting and time.monotonic() < deadline:
+            await asyncio.sleep(min(2.0, max(deadline - time.monotonic(), 0)))
+            waiting -= set(await client.get_joined_members(room_id))
+        postponed = []
+        for bots, cmd in commands:
+            # commands wait for all their bots to join, they are sent on a later run otherwise
+            if any(bot_id in waiting for bot_id in bots):
+                self.logger.debug("Postponing command %s in %s, waiting for %s to join", cmd, room_id, bots)
+                postponed.append(cmd)
+                continue
+            self.logger.debug("Sending command %s to %s", cmd, room_id)
+            await client.send_text(room_id, cmd)
+            await self._add_bot_action_to_ledger(policy_key, room_id, ' '.join(bots), cmd, writes=writes)
+        if writes is not None:
+            await writes.room_done()
+        if postponed:
+            # reported (and retried by retry-failed) like any other failed room
+            raise BotActionsPostponedError(f"{len(postponed)} commands postponed, {', '.join(sorted(waiting))} "
+                                           f"didn't join within {self.bot_join_timeout}s")
+
+    ####################################################################################################################
+    # User management                                                                                                  #
+    ####################################################################################################################
+
+    async def ensure_user(self, user):
+        # Invite a user (or all users of a user group) to their managed rooms and ensure their power levels
+        with run_context(f"ensure-user:{user}"):
+            rows = await self._get_user_rooms_from_db(user)
+            if not rows:
+                raise UserNotFoundError(f"{user} is not invited to any managed room.")
+            rooms = self._group_user_rooms(rows)
+            results = await gather_bounded([self._ensure_room_users(room_id, {'invitees': invitees})
+                                            for room_id, invitees in rooms.items()], self.max_concurrency)
+            return self._collect_failures(rooms.keys(), results)
+
+    async def offboard_user(self, user):
+        # Kick a user (or all users of a user group) from their managed rooms, reset their power levels
+        # and drop them from the index. Policies listing them will re-invite them on the next ensure-policy.
+        with run_context(f"offboard-user:{user}"):
+            rows = await self._get_user_rooms_from_db(user)
+            if not rows:
+                raise UserNotFoundError(f"{user} is not invited to any managed room.")
+            rooms = self._group_user_rooms(rows)
+            results = await gather_bounded([self._remove_room_users(room_id, invitees.keys())
+                                            for room_id, invitees in rooms.items()], self.max_concurrency)
+            failures = self._collect_failures(rooms.keys(), results)
+            failed_rooms = {room_id for room_id, _ in failures}
+            for row in rows:
+                if row['matrix_room_id'] not in failed_rooms:
+                    await self._remove_user_room_from_db(row['user_id'], row['policy_key'], row['room_key'])
+            return failures
+
+    async def get_user_rooms(self, user):
+        rows = await self._get_user_rooms_from_db(user)
+        return [dict(row) for row in rows]
+
+    @staticmethod
+    def _group_user_rooms(rows):
+        rooms = {}
+        for row in rows:
+            invitees = rooms.setdefault(row['matrix_room_id'], {})
+            invitees[row['user_id']] = max(invitees.get(row['user_id'], -1), row['power_level'])
+        return rooms
+
+    def _collect_failures(self, room_ids, results):
+        failures = [(room_id, result) for room_id, result in zip(room_ids, results) if isinstance(result, Exception)]
+        for room_id, err in failures:
+            self.logger.error("Failed to update users in %s: %s", room_id, err)
+        return failures
+
+    async def _remove_room_users(self, room_id, users):
+        client = self.accounts.client_for(room_id)
+        room_members = await client.get_joined_members(room_id)
+        power_levels = await client.get_state_event(room_id, EventType.ROOM_POWER_LEVELS, "")
+        changed_power_levels = False
+        for user in users:
+            membership = Membership.JOIN if user in room_members else await self._get_user_membership(room_id, user)
+            if membership in [Membership.JOIN, Membership.INVITE, Membership.KNOCK]:
+                self.logger.debug("Kicking user %s from %s (membership: %s)", user, room_id, membership)
+                await client.kick_user(room_id=room_id, user_id=user, reason="Offboarding.")
+            if user in power_levels.users:
+                del power_levels.users[user]
+                changed_power_levels = True
+        if changed_power_levels:
+            await client.send_state_event(room_id, EventType.ROOM_POWER_LEVELS, power_levels)
+
+    ####################################################################################################################
+    # Enforcement of managed room state                                                                                #
+    ####################################################################################################################
+
+    async def handle_state_event(self, room_id, sender, event_type):
+        # Changes by our own accounts are ignored, all others are enforced per room after a debounce delay
+        field = ENFORCED_EVENT_TYPES.get(event_type)
+        if field is None or sender in {account.mxid for account in self.accounts.accounts}:
+            return
+        if room_id in await self._get_room_index():
+            self.enforcer.schedule(room_id, field)
+
+    async def enforce_room(self, room_id, fields):
+        with run_context(f"enforce:{room_id}"):
+            try:
+                await self._enforce_room(room_id, fields)
+            except Exception as err:
+                self.logger.exception("Failed to enforce %s in %s: %s", ', '.join(sorted(fields)), room_id, err)
+
+    async def _enforce_room(self, room_id, fields):
+        # Reconciles only the changed fields, with the room policy as ensure-policy would implement it
+        index = await self._get_room_index()
+        if room_id not in index:
+            return
+        policy_key, room_key, compiled = index.lookup(room_id)
+        if compiled is None:
+            compiled = index.compiled[policy_key] = self._compile_room_policies(await self.get_policy(policy_key))
+        if room_key not in compiled:
+            return
+        room_policy = compiled[room_key]
+        self.logger.info("Enforcing %s in %s:%s", ', '.join(sorted(fields)), policy_key, room_key)
+        for field in sorted(fields):
+            if field == 'invitees':
+                await self._ensure_room_users(room_id, room_policy)
+            elif field == 'join_rule':
+                parent_spaces = await self._resolve_parent_spaces(policy_key, room_policy.get('parent_spaces', []) +
+                                                                  room_policy.get('allow_spaces', []))
+                await self._set_room_join_rules(room_id, room_policy['join_rule'], parent_spaces)
+            elif field == 'room_name' and 'room_name' in room_policy:
+                await self._set_room_state(room_id, 'name', room_policy['room_name'])
+            elif field in room_policy:
+                await self._set_room_state(room_id, field, room_policy[field])
+
+    async def _get_room_index(self):
+        # Built from the rooms table on first use, dropped whenever policies or their rooms change
+        if self.room_index is None:
+            rows = await self.database.fetch("SELECT policy_key, room_key, matrix_room_id FROM rooms")
+            self.room_index = RoomIndex({row['matrix_room_id']: (row['policy_key'], row['room_key']) for row in rows})
+        return self.room_index
+
+    @classmethod
+    def _compile_room_policies(cls, policy):
+        # invitees expanded and default room settings applied, like _ensure_room_config does
+        default_room_settings = policy['default_room_settings'] if 'default_room_settings' in policy else {}
+        compiled = {}
+        for room_key, room_policy in iter_policy_rooms(policy):
+            room_policy = dict(room_policy)
+            for key in ['join_rule', 'history_visibility', 'guest_access']:
+                if key not in room_policy and key in default_room_settings:
+                    room_policy[key] = default_room_settings[key]
+            room_policy.setdefault('join_rule', 'restricted')
+            room_policy['invitees'] = cls._expand_invitees(policy, room_policy)
+            compiled[room_key] = room_policy
+        return compiled
+
+    ####################################################################################################################
+    # Locking                                                                                                          #
+    ####################################################################################################################
+
+    @asynccontextmanager
+    async def _policy_lock(self, policy_key):
+        # Local lock for runs in this instance, plus a lease in the db for instances sharing the database
+        async with self.policy_locks.setdefault(policy_key, asyncio.Lock()):
+            await self._acquire_lease(policy_key)
+            renewal = asyncio.ensure_future(self._renew_lease(policy_key))
+            try:
+                yield
+            finally:
+                renewal.cancel()
+                await self._release_lease(policy_key)
+
+    async def _acquire_lease(self, policy_key):
+        waited = 0
+        while not await self._try_lease(policy_key):
+            if waited >= self.lease_wait:
+                holder = await self.database.fetchval("SELECT holder FROM policy_leases WHERE policy_key=$1",
+                                                      policy_key)
+                raise PolicyLockedError(f"Policy {policy_key} is being ensured by {holder}, try again later")
+            if waited == 0:
+                self.logger.info("Policy %s is leased by another instance, waiting", policy_key)
+            await asyncio.sleep(5)
+            waited += 5
+
+    async def _try_lease(self, policy_key):
+        now = int(time.time() * 1000)
+        q = """INSERT INTO policy_leases (policy_key, holder, expires_at) VALUES ($1, $2, $3)
+               ON CONFLICT (policy_key) DO UPDATE SET holder = excluded.holder, expires_at = excluded.expires_at
+               WHERE policy_leases.expires_at < $4 OR policy_leases.holder = $2"""
+        await self.database.execute(q, policy_key, self.lease_holder, now + self.lease_ttl * 1000, now)
+        holder = await self.database.fetchval("SELECT holder FROM policy_leases WHERE policy_key=$1", policy_key)
+        return holder == self.lease_holder
+
+    async def _renew_lease(self, policy_key):
+        # Runs take longer than the lease, it's renewed while they last and expires if this instance dies
+        while True:
+            await asyncio.sleep(self.lease_ttl / 3)
+            try:
+                if not await self._try_lease(policy_key):
+                    self.logger.error("Lost the lease on policy %s", policy_key)
+            except Exception as err:
+                self.logger.error("Failed to renew the lease on policy %s: %s", policy_key, err)
+
+    async def _release_lease(self, policy_key):
+        q = "DELETE FROM policy_leases WHERE policy_key=$1 AND holder=$2"
+        await self.database.execute(q, policy_key, self.lease_holder)
 
     ####################################################################################################################
     # Database management                                                                                              #
     ####################################################################################################################
 
-    async def _add_room_to_db(self, policy_key: str, room_key: str, matrix_room_id: str) -> None:
-        self.logger.info(f"Adding room {policy_key}:{room_key} to db")
-        q = "INSERT INTO rooms (policy_key, room_key, matrix_room_id) VALUES ($1, $2, $3)"
-        await self.database.execute(q, policy_key, room_key, matrix_room_id)
+    async def _execute(self, q, *args, writes=None):
+        # Runs a write right away, or adds it to a WriteBuffer
+        if writes is None:
+            await self.database.execute(q, *args)
+        else:
+            writes.add(q, *args)
+
+    async def _get_room_ids_from_db(self, policy_key):
+        q = "SELECT room_key, matrix_room_id FROM rooms WHERE policy_key = $1"
+        return {row['room_key']: row['matrix_room_id'] for row in await self.database.fetch(q, policy_key)}
+
+    async def _add_room_to_db(self, policy_key: str, room_key: str, matrix_room_id: str, writes=None) -> None:
+        self.logger.info("Adding room %s:%s to db", policy_key, room_key)
+        q = """
+            INSERT INTO rooms (policy_key, room_key, matrix_room_id) VALUES ($1, $2, $3)
+            ON CONFLICT (policy_key, room_key) DO UPDATE SET matrix_room_id = excluded.matrix_room_id
+        """
+        await self._execute(q, policy_key, room_key, matrix_room_id, writes=writes)
 
     async def _get_room_from_db(self, policy_key: str, room_key: str) -> str:
         q = "SELECT policy_key, room_key, matrix_room_id FROM rooms WHERE policy_key=$1 AND room_key=$2"
@@ -369,45 +1138,156 @@ class MatrixSecretary:
             raise DatabaseEntryNotFoundException(f"Could not find {policy_key}:{room_key} in database")
         # am I in this room? is it accessible, e.g. in a space I'm in?
         try:
-            if self.mxid not in await self.client.get_joined_members(row['matrix_room_id']):
-                self.client.join_room(row['matrix_room_id'])
+            try:
+                is_member = self.mxid in await self.client.get_joined_members(row['matrix_room_id'])
+            except MForbidden:
+                is_member = False
+            if not is_member:
+                await self._ensure_joined(row['matrix_room_id'])
         except MForbidden:
-            self.logger.exception(f"Room {row['matrix_room_id']} not accessible, removing from db to recreate")
+            self.logger.exception("Room %s not accessible, removing from db to recreate", row['matrix_room_id'])
             await self._remove_room_from_db(policy_key, room_key)
             raise DatabaseEntryNotFoundException(f"Could not access {policy_key}:{room_key}, dropped from db, recreate")
         return row['matrix_room_id']
 
+    async def _forget_room(self, policy_key, room_key, room_id):
+        await self._remove_room_from_db(policy_key, room_key)
+        q = "DELETE FROM user_rooms WHERE policy_key=$1 AND room_key=$2"
+        await self.database.execute(q, policy_key, room_key)
+        q = "DELETE FROM bot_action_ledger WHERE policy_key=$1 AND matrix_room_id=$2"
+        await self.database.execute(q, policy_key, room_id)
+        await self._remove_failed_room_from_db(policy_key, room_key)
+        self.room_index = None
+
     async def _remove_room_from_db(self, policy_key, room_key):
-        self.logger.debug(f"Removing room {policy_key}:{room_key} from db")
+        self.logger.debug("Removing room %s:%s from db", policy_key, room_key)
         q = "DELETE FROM rooms WHERE policy_key=$1 AND room_key=$2"
         await self.database.execute(q, policy_key, room_key)
 
-    async def _add_policy_to_db(self, policy) -> None:
+    @staticmethod
+    def _index_room_users(writes, policy_key, room_key, room_id, invitees, invitee_groups):
+        # Reverse index user -> managed rooms, replaced per room on every ensure
+        q = "DELETE FROM user_rooms WHERE policy_key=$1 AND room_key=$2"
+        writes.add(q, policy_key, room_key)
+        q = """INSERT INTO user_rooms (user_id, policy_key, room_key, matrix_room_id, power_level, user_group)
+               VALUES ($1, $2, $3, $4, $5, $6)"""
+        for user, pl in invitees.items():
+            writes.add(q, user, policy_key, room_key, room_id, pl, invitee_groups.get(user))
+
+    async def _get_user_rooms_from_db(self, user):
+        # user is either a user id or the name of a user group
+        column = 'user_id' if user.startswith('@') else 'user_group'
+        q = f"""SELECT user_id, policy_key, room_key, matrix_room_id, power_level, user_group
+                FROM user_rooms WHERE {column}=$1"""
+        return await self.database.fetch(q, user)
+
+    async def _remove_user_room_from_db(self, user, policy_key, room_key):
+        q = "DELETE FROM user_rooms WHERE user_id=$1 AND policy_key=$2 AND room_key=$3"
+        await self.database.execute(q, user, policy_key, room_key)
+
+    async def _get_bot_action_ledger_from_db(self, policy_key):
+        q = "SELECT matrix_room_id, bots, command FROM bot_action_ledger WHERE policy_key=$1"
+        rows = await self.database.fetch(q, policy_key)
+        return {(row['matrix_room_id'], row['bots'], row['command']) for row in rows}
+
+    async def _add_bot_action_to_ledger(self, policy_key, room_id, bots, command, writes=None):
+        q = """INSERT INTO bot_action_ledger (policy_key, matrix_room_id, bots, command, sent_at)
+               VALUES ($1, $2, $3, $4, $5) ON CONFLICT DO NOTHING"""
+        await self._execute(q, policy_key, room_id, bots, command, int(time.time() * 1000), writes=writes)
+
+    async def _add_policy_to_db(self, policy, writes=None) -> None:
         policy_key = policy['policy_key']
-        self.logger.info(f"Adding policy {policy_key} to db")
+        self.logger.info("Adding policy %s to db", policy_key)
         q = """
-            INSERT INTO policies (policy_key, policy_json) VALUES ($1, $2)
-            ON CONFLICT (policy_key) DO UPDATE SET policy_json = excluded.policy_json;
+            INSERT INTO policies (policy_key, policy_data) VALUES ($1, $2)
+            ON CONFLICT (policy_key) DO UPDATE SET policy_data = excluded.policy_data;
         """
         # TODO (here, though?!) validate_policy(policy, self.logger)
-        await self.database.execute(q, policy_key, json.dumps(policy))
+        await self._execute(q, policy_key, encode_policy(policy, codec=self.policy_codec), writes=writes)
+
+    @staticmethod
+    def _record_failed_rooms(writes, policy_key, scope, failures):
+        # Failures of a run replace the ones of the rooms it covered
+        if scope is None:
+            writes.add("DELETE FROM failed_rooms WHERE policy_key=$1", policy_key)
+        else:
+            for room_key in scope:
+                writes.add("DELETE FROM failed_rooms WHERE policy_key=$1 AND room_key=$2", policy_key, room_key)
+        q = """INSERT INTO failed_rooms (policy_key, room_key, phase, error, failed_at) VALUES ($1, $2, $3, $4, $5)
+               ON CONFLICT (policy_key, room_key) DO UPDATE
+               SET phase = excluded.phase, error = excluded.error, failed_at = excluded.failed_at"""
+        failed_at = int(time.time() * 1000)
+        for room_key, (phase, err) in failures.items():
+            writes.add(q, policy_key, room_key, phase, f"{type(err).__name__}: {err}", failed_at)
+
+    async def _get_failed_rooms_from_db(self, policy_key):
+        q = "SELECT room_key, phase, error, failed_at FROM failed_rooms WHERE policy_key=$1"
+        return await self.database.fetch(q, policy_key)
+
+    async def _remove_failed_room_from_db(self, policy_key, room_key):
+        q = "DELETE FROM failed_rooms WHERE policy_key=$1 AND room_key=$2"
+        await self.database.execute(q, policy_key, room_key)
+
+    async def _get_avatar_from_db(self, avatar_hash):
+        q = "SELECT mxc_uri FROM avatar_cache WHERE content_hash=$1"
+        return await self.database.fetchval(q, avatar_hash)
+
+    async def _add_avatar_to_db(self, avatar_hash, avatar_url):
+        # another instance may have uploaded the same image meanwhile, both URIs serve it
+        q = "INSERT INTO avatar_cache (content_hash, mxc_uri, created_at) VALUES ($1, $2, $3) " \
+            "ON CONFLICT (content_hash) DO NOTHING"
+        await self.database.execute(q, avatar_hash, avatar_url, int(time.time() * 1000))
+
+    def _add_policy_version_to_db(self, writes, policy):
+        # Uploading the same policy again doesn't add a version, blobs are shared between versions and policies.
+        # The version number is computed in the INSERT: a concurrent upload of the same policy that took it fails
+        # the other transaction as a whole instead of skipping a version
+        policy_key = policy['policy_key']
+        policy_hash = hash_policy(policy)
+        self.logger.info("Adding a version of policy %s to db", policy_key)
+        writes.add("INSERT INTO policy_blobs (policy_hash, policy_data) VALUES ($1, $2) "
+                   "ON CONFLICT (policy_hash) DO NOTHING", policy_hash, encode_policy(policy, codec=self.policy_codec))
+        writes.add("""INSERT INTO policy_versions (policy_key, version, policy_hash, created_at)
+                      SELECT $1, COALESCE(MAX(version), 0) + 1, $2, $3 FROM policy_versions WHERE policy_key=$1
+                      HAVING COALESCE((SELECT policy_hash FROM policy_versions WHERE policy_key=$1
+                                       ORDER BY version DESC LIMIT 1), '') <> $2""",
+                   policy_key, policy_hash, int(time.time() * 1000))
+
+    async def _get_policy_versions_from_db(self, policy_key):
+        q = """SELECT version, policy_hash, created_at, ensured_at FROM policy_versions
+               WHERE policy_key=$1 ORDER BY version"""
+        return await self.database.fetch(q, policy_key)
+
+    async def _get_policy_version_from_db(self, policy_key, version):
+        q = """SELECT policy_blobs.policy_data FROM policy_versions
+               JOIN policy_blobs ON policy_blobs.policy_hash = policy_versions.policy_hash
+               WHERE policy_versions.policy_key=$1 AND policy_versions.version=$2"""
+        data = await self.database.fetchval(q, policy_key, version)
+        if data is None:
+            raise DatabaseEntryNotFoundException(f"Could not find version {version} of {policy_key} in database")
+        return decode_policy(data)
+
+    async def _mark_policy_version_ensured(self, policy_key, version):
+        q = "UPDATE policy_versions SET ensured_at=$3 WHERE policy_key=$1 AND version=$2"
+        await self.database.execute(q, policy_key, version, int(time.time() * 1000))
 
     async def _get_policy_from_db(self, policy_key: str) -> str:
-        q = "SELECT policy_key, policy_json FROM policies WHERE policy_key=$1"
+        q = "SELECT policy_key, policy_data FROM policies WHERE policy_key=$1"
         row = await self.database.fetchrow(q, policy_key)
         if not row:
             raise DatabaseEntryNotFoundException(f"Could not find {policy_key} in database")
-        json_policy = json.loads(row['policy_json'])
-        self.logger.debug(f"Found policy {policy_key} in db!")
+        json_policy = decode_policy(row['policy_data'])
+        self.logger.debug("Found policy %s in db!", policy_key)
         return json_policy
 
     async def _get_user_membership(self, room_id, user_id):
+        client = self.accounts.client_for(room_id)
         # Get state-event for user membership
         try:
-            m_event = await self.client.get_state_event(room_id, "m.room.member", user_id)
-            self.logger.debug(f"Got state event for {user_id} in {room_id}: {m_event}")
+            m_event = await client.get_state_event(room_id, "m.room.member", user_id)
+            self.logger.debug("Got state event for %s in %s: %s", user_id, room_id, m_event)
             return m_event['membership']
         except MNotFound:
-            self.logger.debug(f"Could not get membership state event for {user_id} in {room_id}: Not found")
+            self.logger.debug("Could not get membership state event for %s in %s: Not found", user_id, room_id)
             return False
 
@@ -0,0 +1,38 @@
+from mautrix.api import Method
+from mautrix.errors import MForbidden, MNotFound
+
+
+def child_event_content(server, suggested=False):
+    return {'auto_join': False, 'suggested': suggested, 'via': [server]}
+
+
+def parent_event_content(server):
+    return {'canonical': True, 'via': [server]}
+
+
+async def get_space_children(client, space_id):
+    # A single hierarchy request: with max_depth=1 the space itself comes first and carries all its m.space.child events
+    api_link = f"/_matrix/client/v1/rooms/{space_id}/hierarchy"
+    try:
+        hierarchy = await client.api.request(Method.GET, api_link, query_params={'max_depth': '1', 'limit': '1'})
+    except (MForbidden, MNotFound):
+        return {}
+    for room in hierarchy.get('rooms', []):
+        if room['room_id'] == space_id:
+            return {ev['state_key']: ev['content'] for ev in room.get('children_state', [])
+                    if ev.get('type') == 'm.space.child' and ev.get('content')}
+    return {}
+
+
+def diff_space_children(current_children, desired_children, server, managed_room_ids):
+    # Returns the edges to (re)link with their suggested flag and the stale children to unlink.
+    # Only children that belong to the policy are unlinked, other rooms in the space are left alone.
+    to_link = {child_id: suggested for child_id, suggested in desired_children.items()
+               if not _child_content_matches(current_children.get(child_id), server, suggested)}
+    to_unlink = [child_id for child_id in current_children
+                 if child_id not in desired_children and child_id in managed_room_ids]
+    return to_link, to_unlink
+
+
+def _child_content_matches(content, server, suggested):
+    return content is not None and content.get('suggested', False) == suggested and server in content.get('via', [])
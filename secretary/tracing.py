@@ -0,0 +1,117 @@
+import asyncio
+import functools
+import inspect
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from secretary.util import current_run
+
+
+class Tracer:
+    """Ring buffer of the spans of the last `max_runs` runs (see util.run_context), exported as Chrome trace events.
+
+    Spans outside of a run are not recorded. Each asyncio task gets its own lane (tid), so concurrency is visible.
+    """
+
+    def __init__(self, max_runs=10, max_spans=100000):
+        self.max_runs = max_runs
+        self.max_spans = max_spans
+        self.runs = OrderedDict()
+
+    @contextmanager
+    def span(self, name, cat='secretary', **args):
+        run_id = current_run.get()
+        if run_id == '-':
+            yield
+            return
+        start = time.perf_counter_ns()
+        try:
+            yield
+        finally:
+            self._add(run_id, name, cat, start, time.perf_counter_ns() - start, args)
+
+    def _add(self, run_id, name, cat, start, duration, args):
+        if run_id not in self.runs:
+            self.runs[run_id] = {'spans': [], 'lanes': {}, 'dropped': 0}
+            while len(self.runs) > self.max_runs:
+                self.runs.popitem(last=False)
+        run = self.runs[run_id]
+        if len(run['spans']) >= self.max_spans:
+            run['dropped'] += 1
+            return
+        task = asyncio.current_task() if _in_event_loop() else None
+        lane = run['lanes'].setdefault(id(task), len(run['lanes']) + 1)
+        run['spans'].append((name, cat, start, duration, lane, args))
+
+    def get_run_ids(self):
+        return list(self.runs.keys())
+
+    def find_run(self, run=None):
+        # The latest run, or the latest one whose id starts with `run` (e.g. "ensure:nina")
+        for run_id in reversed(self.runs.keys()):
+            if run is None or run_id.startswith(run):
+                return run_id
+        return None
+
+    def chrome_trace(self, run_id):
+        run = self.runs[run_id]
+        origin = min((start for _, _, start, _, _, _ in run['spans']), default=0)
+        events = [{'name': name, 'cat': cat, 'ph': 'X', 'pid': 1, 'tid': lane,
+                   'ts': (start - origin) / 1000, 'dur': duration / 1000,
+                   'args': {k: str(v) for k, v in args.items()}}
+                  for name, cat, start, duration, lane, args in run['spans']]
+        events.append({'name': 'process_name', 'ph': 'M', 'pid': 1, 'args': {'name': run_id}})
+        return {'traceEvents': events, 'displayTimeUnit': 'ms',
+                'otherData': {'run': run_id, 'dropped_spans': run['dropped']}}
+
+
+tracer = Tracer()
+
+
+def span(name, cat='secretary', **args):
+    return tracer.span(name, cat=cat, **args)
+
+
+def traced(cat='secretary', args=()):
+    # Decorator for coroutine methods: one span per call, named after the method, recording the given arguments
+    def decorator(func):
+        signature = inspect.signature(func)
+
+        @functools.wraps(func)
+        async def wrapper(*a, **kw):
+            if current_run.get() == '-':
+                return await func(*a, **kw)
+            bound = signature.bind_partial(*a, **kw).arguments
+            with tracer.span(func.__name__, cat=cat, **{k: bound[k] for k in args if k in bound}):
+                return await func(*a, **kw)
+
+        return wrapper
+
+    return decorator
+
+
+class TracedDatabase:
+    """Wraps the plugin database so that every query is a span."""
+
+    def __init__(self, database):
+        self.database = database
+
+    def __getattr__(self, name):
+        attr = getattr(self.database, name)
+        if not inspect.iscoroutinefunction(attr):
+            return attr
+
+        async def call(query, *args, **kwargs):
+            with tracer.span(name, cat='db', query=' '.join(query.split())[:120]):
+                return await attr(query, *args, **kwargs)
+
+        return call
+
+
+def _in_event_loop():
+    try:
+        asyncio.get_running_loop()
+        return True
+    except RuntimeError:
+        return False
@@ -1,13 +1,16 @@
+import asyncio
+import copy
 import logging
+import os
+import queue
 import traceback
 import re
+import uuid
+from contextlib import contextmanager
+from contextvars import ContextVar
+from logging.handlers import QueueHandler, QueueListener
 from typing import Tuple, Any
 
-from secretary.example_policies.corner_cases import get_corner_cases_policy
-from secretary.example_policies.minimal_policy import get_minimal_policy
-from secretary.example_policies.nina import get_nina_policy
-from secretary.example_policies.policy_schema import get_schema
-
 
 class PolicyNotFoundError(Exception):
     pass
@@ -17,25 +20,77 @@ class DatabaseEntryNotFoundException(Exception):
     pass
 
 
+class AdminAPIUnavailableError(Exception):
+    pass
+
+
+class PolicyLockedError(Exception):
+    pass
+
+
+class UserNotFoundError(Exception):
+    pass
+
+
+class BotActionsPostponedError(Exception):
+    pass
+
+
 async def log_error(logger, err, evt):
     logger.exception(err)
     await evt.respond(f"I tried, but something went wrong: \"{err}\"")
     await evt.respond(f"```\n{traceback.format_exc()}\n```")
 
 
+async def gather_bounded(coros, limit):
+    # Runs coroutines concurrently, at most limit at a time. coros may be a lazy iterable, it is only consumed
+    # as running coroutines finish. Results (or raised exceptions) are returned in input order.
+    results = []
+    pending = {}
+
+    def collect(done):
+        for task in done:
+            results[pending.pop(task)] = task.exception() or task.result()
+
+    try:
+        for index, coro in enumerate(coros):
+            if len(pending) >= limit:
+                done, _ = await asyncio.wait(pending.keys(), return_when=asyncio.FIRST_COMPLETED)
+                collect(done)
+            results.append(None)
+            pending[asyncio.ensure_future(coro)] = index
+    except asyncio.CancelledError:
+        for task in pending:
+            task.cancel()
+        if pending:
+            await asyncio.wait(pending.keys())
+        raise
+    except Exception:
+        # The input failed (e.g. a room template): coroutines already running finish before the error is raised,
+        # so nothing is left running once the caller cleans up (e.g. flushes its writes)
+        if pending:
+            await asyncio.wait(pending.keys())
+        raise
+    if pending:
+        done, _ = await asyncio.wait(pending.keys())
+        collect(done)
+    return results
+
+
 def non_empty_string(x: str) -> Tuple[str, Any]:
     if not x:
         return x, None
     return "", x
 
 
-def get_example_policies():
-    policies = [get_nina_policy(small=True),
-                get_nina_policy(small=False),
-                get_minimal_policy(),
-                get_corner_cases_policy(),
-                ]
-    return policies
+def parse_options(args: str) -> Tuple[str, dict]:
+    # "nina --subtree Baden-Württemberg --gzip" -> ("nina", {"subtree": "Baden-Württemberg", "gzip": True})
+    positional, *parts = re.split(r"(?:^|\s+)--", args.strip())
+    options = {}
+    for part in parts:
+        name, _, value = part.partition(' ')
+        options[name] = value.strip() or True
+    return positional.strip(), options
 
 
 def escape_as_alias(alias: str) -> str:
@@ -58,6 +113,13 @@ def is_legal(key, value):
         raise ValueError(f'Not a valid {key}: \"{value}\"')
 
 
+def confined_path(path, directory):
+    # path (a leading / too) relative to directory, None if it resolves outside of it (e.g. via .. or a symlink)
+    root = os.path.realpath(directory)
+    resolved = os.path.realpath(os.path.join(root, path.lstrip('/')))
+    return resolved if os.path.commonpath([root, resolved]) == root else None
+
+
 def is_matrix_room_id(string):
     return re.compile(r"^!.*:.*$").match(string)
 
@@ -74,25 +136,105 @@ def is_legal_mxc_url(string):
     return re.compile(r"^mxc://.*$").match(string)
 
 
-def get_logger(stream_level=logging.INFO, file_level=logging.DEBUG, log_file_path=None):
-    # Create a logger object
+class DebugSampler(logging.Filter):
+    # Lets through the first and then every 1/rate-th debug record per call site, other levels always pass
+    def __init__(self, rate=1.0):
+        super().__init__()
+        self.rate = rate
+        self.counts = {}
+
+    def filter(self, record):
+        if record.levelno != logging.DEBUG or self.rate >= 1:
+            return True
+        if self.rate <= 0:
+            return False
+        site = (record.pathname, record.lineno)
+        count = self.counts.get(site, 0)
+        self.counts[site] = count + 1
+        return count % round(1 / self.rate) == 0
+
+
+class RunContextFilter(logging.Filter):
+    # Adds the id of the current run (see run_context) to every record
+    def filter(self, record):
+        record.run = current_run.get()
+        return True
+
+
+class DeferredQueueHandler(QueueHandler):
+    def prepare(self, record):
+        # The message is merged with its arguments here, before the caller can change them (invitee dicts, power
+        # levels). Records dropped by the debug sampler or below every handler's level never get here, so they are
+        # never formatted. The listener thread only adds the timestamp and level
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+
+current_run = ContextVar('secretary_run', default='-')
+_debug_sampler = DebugSampler()
+_log_listener = None
+
+
+@contextmanager
+def run_context(name):
+    # Tags all log records of the current task (and tasks spawned from it) with a run id
+    run_id = f"{name}-{uuid.uuid4().hex[:8]}"
+    token = current_run.set(run_id)
+    try:
+        yield run_id
+    finally:
+        current_run.reset(token)
+
+
+def get_logger(stream_level=logging.INFO, file_level=logging.DEBUG, log_file_path=None, debug_sample_rate=None):
+    # Handlers are only set up on the first call: records are queued by the caller and formatted
+    # and written by a QueueListener thread, so logging doesn't block the event loop.
+    global _log_listener
     logger = logging.getLogger(__name__)
+    if debug_sample_rate is not None:
+        _debug_sampler.rate = debug_sample_rate
+    if _log_listener is not None:
+        return logger
     logger.setLevel(logging.DEBUG)
 
     # Create a formatter
-    formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
+    formatter = logging.Formatter('%(asctime)s - %(levelname)s - [%(run)s] %(message)s')
+    handlers = []
 
-    # Create a file handler and add it to the logger
+    # Create a file handler
     if log_file_path:
         file_handler = logging.FileHandler(log_file_path)
         file_handler.setLevel(file_level)
         file_handler.setFormatter(formatter)
-        logger.addHandler(file_handler)
+        handlers.append(file_handler)
 
-    # Create a stream handler and add it to the logger
+    # Create a stream handler
     stream_handler = logging.StreamHandler()
     stream_handler.setLevel(stream_level)
     stream_handler.setFormatter(formatter)
-    logger.addHandler(stream_handler)
+    handlers.append(stream_handler)
+
+    log_queue = queue.SimpleQueue()
+    queue_handler = DeferredQueueHandler(log_queue)
+    queue_handler.setLevel(min(handler.level for handler in handlers))
+    queue_handler.addFilter(_debug_sampler)
+    queue_handler.addFilter(RunContextFilter())
+    logger.addHandler(queue_handler)
+    _log_listener = QueueListener(log_queue, *handlers, respect_handler_level=True)
+    _log_listener.start()
 
     return logger
+
+
+def stop_logging():
+    # Flushes queued records, the next get_logger call sets logging up again
+    global _log_listener
+    if _log_listener is None:
+        return
+    _log_listener.stop()
+    _log_listener = None
+    logger = logging.getLogger(__name__)
+    for handler in [h for h in logger.handlers if isinstance(h, DeferredQueueHandler)]:
+        logger.removeHandler(handler)
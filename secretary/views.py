@@ -0,0 +1,58 @@
+import json
+
+from secretary.generators import iter_policy_rooms
+
+# Replies are sent with a plain and an HTML body, events must stay below 64 KiB in total
+MAX_INLINE_BYTES = 24 * 1024
+
+
+def select_path(policy, path):
+    # "rooms.Bayern.invitees", "user_groups", "rooms.*.alias" (* selects every key), list items by index.
+    # Keys may contain dots themselves, the longest matching key wins. Generated rooms can be selected like static ones.
+    if not path:
+        return policy
+    return _select(policy, path.split('.'), [], policy)
+
+
+def _select(obj, segments, seen, policy):
+    if not segments:
+        return obj
+    if seen == ['rooms'] and isinstance(obj, dict):
+        obj = _with_generated_rooms(obj, policy, segments)
+    if segments[0] == '*' and isinstance(obj, (dict, list)):
+        items = obj.items() if isinstance(obj, dict) else enumerate(obj)
+        return {str(k): _select(v, segments[1:], seen + [str(k)], policy) for k, v in items
+                if _has_path(v, segments[1:])}
+    if isinstance(obj, list):
+        if not segments[0].isdigit() or int(segments[0]) >= len(obj):
+            raise KeyError(f"No item {segments[0]} in {'.'.join(seen) or 'policy'}")
+        return _select(obj[int(segments[0])], segments[1:], seen + [segments[0]], policy)
+    if isinstance(obj, dict):
+        for n in range(len(segments), 0, -1):
+            key = '.'.join(segments[:n])
+            if key in obj:
+                return _select(obj[key], segments[n:], seen + [key], policy)
+    raise KeyError(f"No {segments[0]} in {'.'.join(seen) or 'policy'}")
+
+
+def _with_generated_rooms(rooms, policy, segments):
+    # Generated rooms are only materialized if the selected room is not a static one
+    if policy is None:
+        return rooms
+    if segments[0] != '*' and any('.'.join(segments[:n]) in rooms for n in range(1, len(segments) + 1)):
+        return rooms
+    return dict(iter_policy_rooms(policy))
+
+
+def _has_path(obj, segments):
+    try:
+        _select(obj, segments, [], None)
+        return True
+    except KeyError:
+        return False
+
+
+def render(obj):
+    # Returns the pretty printed JSON and whether it's small enough to be sent inline
+    text = json.dumps(obj, indent=4, ensure_ascii=False)
+    return text, len(text.encode('utf-8')) <= MAX_INLINE_BYTES
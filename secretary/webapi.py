@@ -0,0 +1,51 @@
+import hashlib
+import hmac
+import json
+
+from aiohttp.web import Request, Response, json_response
+
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+
+
+def page_params(request: Request):
+    # ?offset=0&limit=100, raises ValueError for invalid values
+    offset = int(request.query.get('offset', 0))
+    limit = int(request.query.get('limit', DEFAULT_PAGE_SIZE))
+    if offset < 0 or not 0 < limit <= MAX_PAGE_SIZE:
+        raise ValueError(f"offset must be >= 0 and limit between 1 and {MAX_PAGE_SIZE}")
+    return offset, limit
+
+
+def paginate(items, offset, limit):
+    return {
+        'items': items[offset:offset + limit],
+        'offset': offset,
+        'limit': limit,
+        'total': len(items),
+        'next_offset': offset + limit if offset + limit < len(items) else None,
+    }
+
+
+def make_etag(*parts):
+    digest = hashlib.sha256(json.dumps(parts, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+    return f'"{digest[:32]}"'
+
+
+async def cached_response(request: Request, etag, build):
+    # build() is only awaited if the client's copy is outdated
+    if etag in [tag.strip() for tag in request.headers.get('If-None-Match', '').split(',')]:
+        return Response(status=304, headers={'ETag': etag})
+    return json_response(await build(), headers={'ETag': etag, 'Cache-Control': 'no-cache'})
+
+
+def error_response(status, message):
+    return json_response({'error': message}, status=status)
+
+
+def is_authorized(request: Request, token):
+    # Without a configured token the API is disabled
+    if not token:
+        return False
+    scheme, _, given = request.headers.get('Authorization', '').partition(' ')
+    return scheme.lower() == 'bearer' and hmac.compare_digest(given.strip(), token)
@@ -0,0 +1,140 @@
+"""A stand-in for the Synapse admin API endpoints used by SynapseAdminAPI, to try the fast paths without a homeserver.
+
+Serves a few made-up rooms from memory. Requests need the bearer token given with --token.
+Run from the repository root, --check imports the plugin and needs maubot (and with it mautrix and aiohttp):
+    PYTHONPATH=. python tools/fake_synapse_admin.py [--port 8008] [--token secret]   serve it
+    PYTHONPATH=. python tools/fake_synapse_admin.py --check                     run SynapseAdminAPI against it and exit
+"""
+import argparse
+import asyncio
+
+from aiohttp import web, ClientSession
+
+ADMIN_USER = '@admin:example.org'
+
+
+def make_rooms(count=5):
+    return {f"!room{i}:example.org": {'room_id': f"!room{i}:example.org", 'name': f"Room {i}",
+                                      'canonical_alias': f"#room{i}:example.org", 'joined_members': i + 1,
+                                      'joined_local_members': i + 1, 'members': [ADMIN_USER]}
+            for i in range(count)}
+
+
+def make_app(token, rooms=None):
+    app = web.Application()
+    app['rooms'] = make_rooms() if rooms is None else rooms
+
+    def error(status, errcode, message):
+        return web.json_response({'errcode': errcode, 'error': message}, status=status)
+
+    @web.middleware
+    async def authorize(request, handler):
+        if request.headers.get('Authorization') != f"Bearer {token}":
+            return error(401, 'M_UNKNOWN_TOKEN', "Invalid access token")
+        return await handler(request)
+
+    def find_room(request):
+        return app['rooms'].get(request.match_info['room_id'])
+
+    async def list_rooms(request):
+        start = int(request.query.get('from', 0))
+        limit = int(request.query.get('limit', 100))
+        room_list = list(app['rooms'].values())
+        page = room_list[start:start + limit]
+        next_batch = start + limit if start + limit < len(room_list) else None
+        return web.json_response({'rooms': page, 'offset': start, 'total_rooms': len(room_list),
+                                  'next_batch': next_batch})
+
+    async def get_room(request):
+        room = find_room(request)
+        if room is None:
+            return error(404, 'M_NOT_FOUND', "Room not found")
+        return web.json_response(room)
+
+    async def delete_room(request):
+        room = app['rooms'].pop(request.match_info['room_id'], None)
+        if room is None:
+            return error(404, 'M_NOT_FOUND', "Room not found")
+        return web.json_response({'delete_id': f"delete_{room['room_id']}"})
+
+    async def join_user(request):
+        room = find_room(request)
+        if room is None:
+            return error(404, 'M_NOT_FOUND', "Room not found")
+        room['members'].append((await request.json())['user_id'])
+        return web.json_response({'room_id': room['room_id']})
+
+    async def unrecognized(request):
+        return error(404, 'M_UNRECOGNIZED', "Unrecognized request")
+
+    app.middlewares.append(authorize)
+    app.router.add_get('/_synapse/admin/v1/rooms', list_rooms)
+    app.router.add_get('/_synapse/admin/v1/rooms/{room_id}', get_room)
+    app.router.add_delete('/_synapse/admin/v2/rooms/{room_id}', delete_room)
+    app.router.add_post('/_synapse/admin/v1/join/{room_id}', join_user)
+    app.router.add_route('*', '/{tail:.*}', unrecognized)
+    return app
+
+
+async def check(port=8765, token='secret'):
+    # Exercises list_rooms, get_room and delete_room, including errors that must not disable the admin API
+    from mautrix.api import Method
+    from mautrix.errors import MNotFound
+
+    from secretary.admin_api import SynapseAdminAPI
+    from secretary.util import AdminAPIUnavailableError
+
+    runner = web.AppRunner(make_app(token))
+    await runner.setup()
+    await web.TCPSite(runner, 'localhost', port).start()
+    base_url = f"http://localhost:{port}"
+    try:
+        async with ClientSession() as session:
+            admin_api = SynapseAdminAPI(base_url, token, client_session=session)
+            rooms = await admin_api.list_rooms(page_size=2)
+            assert len(rooms) == 5, rooms
+            assert (await admin_api.get_room('!room1:example.org'))['name'] == "Room 1"
+            await admin_api.delete_room('!room1:example.org')
+            for call in [admin_api.get_room, admin_api.delete_room]:
+                try:
+                    await call('!room1:example.org')
+                    raise AssertionError("deleted room still found")
+                except MNotFound:
+                    pass
+            assert admin_api.available, "M_NOT_FOUND disabled the admin API"
+            assert len(await admin_api.list_rooms()) == 4
+
+            refused = SynapseAdminAPI(base_url, 'wrong token', client_session=session)
+            try:
+                await refused.list_rooms()
+                raise AssertionError("wrong token accepted")
+            except AdminAPIUnavailableError:
+                pass
+            assert not refused.available, "a refused request didn't disable the admin API"
+
+            unrecognized = SynapseAdminAPI(base_url, token, client_session=session)
+            try:
+                await unrecognized.request(Method.GET, "/_synapse/admin/v1/unknown")
+                raise AssertionError("unknown endpoint answered")
+            except AdminAPIUnavailableError:
+                pass
+            assert not unrecognized.available, "M_UNRECOGNIZED didn't disable the admin API"
+            print("Admin API checks passed")
+    finally:
+        await runner.cleanup()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve a fake Synapse admin API")
+    parser.add_argument('--port', type=int, default=8008)
+    parser.add_argument('--token', default='secret')
+    parser.add_argument('--check', action='store_true', help="run SynapseAdminAPI against the fake server and exit")
+    args = parser.parse_args()
+    if args.check:
+        asyncio.run(check(token=args.token))
+    else:
+        web.run_app(make_app(args.token), port=args.port)
+
+
+if __name__ == '__main__':
+    main()